@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Author:         Carl, Chris
+Email:          chrisbcarl@gmail.com
+Date:           2021-02-27
+Description:
+
+Load driver for general-flask-sqlalchemy-api.py, meant to run against a
+database made by seed.py so runs are comparable:
+
+    python seed.py --rows 1000000 --conf ignoreme/seed.conf
+    python general-flask-sqlalchemy-api.py --config ignoreme/seed.conf --cache-ttl 0
+    python bench.py --concurrency 1,4,16 --duration 10
+    python bench.py --compare ignoreme/bench-<earlier>.json
+
+Every scenario runs for --duration seconds at every --concurrency level, one
+keep-alive connection per thread. Throughput and latency percentiles go to
+stdout and, with the environment they came from, to a json file.
+
+The writes only touch rows the run itself POSTed, so the seeded rows stay put.
+
+The read scenarios repeat the same GETs, which the api's response cache
+answers from memory unless it runs with --cache-ttl 0, so that's how the
+queries and the serializing get measured. Every result says how many of its
+requests were cache hits, out of /api/v1/_stats, and a run that had any says
+so at the end.
+'''
+
+# stdlib imports
+from __future__ import print_function, absolute_import, division
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import multiprocessing
+import threading
+import subprocess
+from collections import OrderedDict, deque
+from timeit import default_timer
+
+# 3rd party imports
+from six.moves import http_client
+from six.moves.urllib.parse import urlsplit, urlencode
+
+# constants
+FILE_DIRPATH = os.path.abspath(os.path.dirname(__file__))
+CACHE_DIRPATH = os.path.join(FILE_DIRPATH, 'ignoreme')
+API = '/api/v1'
+STATUSES = ['new', 'open', 'pending', 'closed', 'archived']
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Client(object):
+    # one per thread, a keep-alive connection that reconnects when the server drops it
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        # type: (str, str, object, dict) -> tuple
+        headers = dict(headers or {})
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http_client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status, dict(response.getheaders()), data
+            except (http_client.HTTPException, socket.error):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Run(object):
+    # shared between the threads of a run: the ids this run created, so writes never touch seeded rows
+    def __init__(self, rows, id_base):
+        self.rows = rows
+        self.lock = threading.Lock()
+        self.next_id = id_base
+        self.created = deque()
+
+    def new_ids(self, count):
+        with self.lock:
+            start = self.next_id
+            self.next_id += count
+        return list(range(start, start + count))
+
+    def created_id(self):
+        with self.lock:
+            if not self.created:
+                return None
+            id_ = self.created.popleft()
+            self.created.append(id_)
+            return id_
+
+    def take_created_id(self):
+        with self.lock:
+            return self.created.popleft() if self.created else None
+
+    def remember(self, ids):
+        with self.lock:
+            self.created.extend(ids)
+
+
+def _narrow_row(id_, rng):
+    return dict(
+        id=id_,
+        name='bench {}'.format(id_),
+        age=rng.randint(0, 99),
+        status=rng.choice(STATUSES),
+        amount='{}.{:02d}'.format(rng.randint(0, 10 ** 6), rng.randint(0, 99)),
+    )
+
+
+def _check(status, data):
+    # the api answers errors with a 200 and an error document, so the status line alone doesn't cut it
+    if status >= 400:
+        return False
+    head = data[:16].replace(b' ', b'').replace(b'\n', b'')
+    return not head.startswith(b'{"error"')
+
+
+def scenario_metadata(client, run, rng):
+    return client.request('GET', '{}/metadata'.format(API))
+
+
+def scenario_get_item(client, run, rng):
+    return client.request('GET', '{}/narrow/{}'.format(API, rng.randint(1, run.rows)))
+
+
+def scenario_list_limit(client, run, rng):
+    return client.request('GET', '{}/narrow?limit=100'.format(API))
+
+
+def scenario_list_ordered(client, run, rng):
+    return client.request('GET', '{}/narrow?order_key=created&order=desc&limit=100'.format(API))
+
+
+def scenario_list_filtered(client, run, rng):
+    args = dict(search_key='status', search=rng.choice(STATUSES), order_key='age', order='asc', limit=100)
+    return client.request('GET', '{}/narrow?{}'.format(API, urlencode(args)))
+
+
+def scenario_list_fields(client, run, rng):
+    return client.request('GET', '{}/wide?fields=id,s000,i001,d002&limit=500'.format(API))
+
+
+def scenario_list_wide(client, run, rng):
+    return client.request('GET', '{}/wide?limit=500'.format(API))
+
+
+def scenario_list_text(client, run, rng):
+    return client.request('GET', '{}/text_heavy?limit=100'.format(API))
+
+
+def scenario_list_composite(client, run, rng):
+    return client.request('GET', '{}/composite?order_key=val&order=asc&limit=200'.format(API))
+
+
+def scenario_cursor_walk(client, run, rng):
+    # ten pages deep, the whole walk is the one measurement
+    path = '{}/narrow?order_key=created&order=asc&limit=100'.format(API)
+    status, headers, data = client.request('GET', path)
+    pages = [data]
+    for _ in range(9):
+        cursor = headers.get('X-Next-Cursor') or headers.get('x-next-cursor')
+        if not cursor or not _check(status, data):
+            break
+        status, headers, data = client.request('GET', '{}&cursor={}'.format(path, cursor))
+        pages.append(data)
+    if not _check(status, data):
+        return status, headers, data
+    return status, headers, b''.join(pages)
+
+
+def scenario_stream(client, run, rng):
+    return client.request('GET', '{}/narrow?stream=1&limit=10000'.format(API))
+
+
+def scenario_post_single(client, run, rng):
+    id_ = run.new_ids(1)[0]
+    result = client.request('POST', '{}/narrow'.format(API), body=_narrow_row(id_, rng))
+    if _check(result[0], result[2]):
+        run.remember([id_])
+    return result
+
+
+def scenario_post_bulk(client, run, rng):
+    ids = run.new_ids(100)
+    result = client.request('POST', '{}/narrow'.format(API), body=[_narrow_row(id_, rng) for id_ in ids])
+    if _check(result[0], result[2]):
+        run.remember(ids)
+    return result
+
+
+def scenario_put_item(client, run, rng):
+    id_ = run.created_id()
+    if id_ is None:
+        return None
+    return client.request('PUT', '{}/narrow/{}'.format(API, id_), body=dict(age=rng.randint(0, 99)))
+
+
+def scenario_put_filter(client, run, rng):
+    id_ = run.created_id()
+    if id_ is None:
+        return None
+    args = dict(search_key='name', search='bench {}'.format(id_))
+    return client.request('PUT', '{}/narrow?{}'.format(API, urlencode(args)), body=dict(age=rng.randint(0, 99)))
+
+
+def scenario_delete_item(client, run, rng):
+    id_ = run.take_created_id()
+    if id_ is None:
+        return None
+    return client.request('DELETE', '{}/narrow/{}'.format(API, id_))
+
+
+SCENARIOS = OrderedDict(
+    (name[len('scenario_'):], func) for name, func in sorted(globals().items()) if name.startswith('scenario_')
+)
+# writes last, so the deletes have something to delete
+SCENARIO_ORDER = [
+    'metadata', 'get_item', 'list_limit', 'list_ordered', 'list_filtered', 'list_fields', 'list_wide', 'list_text',
+    'list_composite', 'cursor_walk', 'stream', 'post_single', 'post_bulk', 'put_item', 'put_filter', 'delete_item'
+]
+
+
+def percentile(sorted_values, q):
+    # type: (list, float) -> float
+    if not sorted_values:
+        return 0.0
+    position = q * (len(sorted_values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def cache_counters(url, timeout):
+    # type: (str, float) -> dict
+    # the response cache's hits and misses so far, None when the api doesn't say
+    client = Client(url, timeout)
+    try:
+        status, _, data = client.request('GET', '{}/_stats'.format(API))
+    except Exception:
+        return None
+    finally:
+        client.close()
+    if status != 200:
+        return None
+    counters = {}
+    for line in data.decode('utf-8').splitlines():
+        for stat in ['hits', 'misses']:
+            if line.startswith('generic_api_response_cache{{stat="{}"}} '.format(stat)):
+                counters[stat] = int(line.split()[-1])
+    return counters if len(counters) == 2 else None
+
+
+def run_scenario(url, run, name, concurrency, duration, timeout, random_seed):
+    # type: (str, Run, str, int, float, float, str) -> OrderedDict
+    func = SCENARIOS[name]
+    latencies, errors, skipped, nbytes = [], [0], [0], [0]
+    lock = threading.Lock()
+    deadline = [None]
+    start = threading.Event()
+
+    def worker(index):
+        client = Client(url, timeout)
+        rng = random.Random('{}:{}:{}:{}'.format(random_seed, name, concurrency, index))
+        mine, my_errors, my_skipped, my_bytes = [], 0, 0, 0
+        start.wait()
+        try:
+            while default_timer() < deadline[0]:
+                started = default_timer()
+                try:
+                    result = func(client, run, rng)
+                except Exception:
+                    my_errors += 1
+                    continue
+                elapsed = default_timer() - started
+                if result is None:
+                    my_skipped += 1
+                    if my_skipped > 1000:
+                        break
+                    continue
+                status, _, data = result
+                if _check(status, data):
+                    mine.append(elapsed)
+                    my_bytes += len(data)
+                else:
+                    my_errors += 1
+        finally:
+            client.close()
+            with lock:
+                latencies.extend(mine)
+                errors[0] += my_errors
+                skipped[0] += my_skipped
+                nbytes[0] += my_bytes
+
+    counters = cache_counters(url, timeout)
+    threads = [threading.Thread(target=worker, args=(i, )) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    began = default_timer()
+    deadline[0] = began + duration
+    start.set()
+    for thread in threads:
+        thread.join()
+    elapsed = default_timer() - began
+    after = cache_counters(url, timeout) if counters is not None else None
+
+    latencies.sort()
+    result = OrderedDict()
+    result['scenario'] = name
+    result['concurrency'] = concurrency
+    result['seconds'] = round(elapsed, 3)
+    result['requests'] = len(latencies)
+    result['errors'] = errors[0]
+    result['skipped'] = skipped[0]
+    result['rps'] = round(len(latencies) / elapsed, 2) if elapsed else 0.0
+    result['mean_bytes'] = int(nbytes[0] / len(latencies)) if latencies else 0
+    for q in QUANTILES:
+        result['p{}_ms'.format(int(q * 100))] = round(percentile(latencies, q) * 1000, 3)
+    result['max_ms'] = round(latencies[-1] * 1000, 3) if latencies else 0.0
+    for stat in ['hits', 'misses']:
+        result['cache_{}'.format(stat)] = None if after is None else after[stat] - counters[stat]
+    return result
+
+
+def environment(url):
+    env = OrderedDict()
+    env['started'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    env['url'] = url
+    env['python'] = sys.version.split()[0]
+    env['platform'] = platform.platform()
+    env['cpus'] = multiprocessing.cpu_count()
+    try:
+        env['git'] = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=FILE_DIRPATH, stderr=subprocess.STDOUT
+        ).decode('ascii').strip()
+    except Exception:
+        env['git'] = None
+    return env
+
+
+def print_table(results, previous=None):
+    columns = ['scenario', 'concurrency', 'requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+    before = {}
+    if previous is not None:
+        for result in previous['results']:
+            before[(result['scenario'], result['concurrency'])] = result
+        columns += ['rps_delta', 'p95_delta']
+    print(' '.join('{:>14}'.format(c) for c in columns))
+    for result in results:
+        values = [result[c] for c in columns if c in result]
+        old = before.get((result['scenario'], result['concurrency']))
+        if previous is not None:
+            for key in ['rps', 'p95_ms']:
+                if old is None or not old[key]:
+                    values.append('')
+                else:
+                    values.append('{:+.1f}%'.format((result[key] - old[key]) * 100.0 / old[key]))
+        print(' '.join('{:>14}'.format(v) for v in values))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'bench', formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__
+    )
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='default "%(default)s"')
+    parser.add_argument('--concurrency', default='1,4,16', help='threads per level, default "%(default)s"')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per scenario per level')
+    parser.add_argument('--scenarios', default=','.join(SCENARIO_ORDER), help='default all of them, in order')
+    parser.add_argument('--rows', type=int, default=100000, help='what seed.py was given for --rows')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds before a request counts as an error')
+    parser.add_argument('--random-seed', default='general-flask-sqlalchemy-api', help='default "%(default)s"')
+    parser.add_argument(
+        '--output', default=None, help='results json, default "{}/bench-<time>.json"'.format(CACHE_DIRPATH)
+    )
+    parser.add_argument('--compare', default=None, help='an earlier results json to put the deltas against')
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(',') if n.strip()]
+    for name in names:
+        if name not in SCENARIOS:
+            raise ValueError('{!r} not in {}'.format(name, list(SCENARIOS)))
+    levels = [int(c) for c in args.concurrency.split(',') if c.strip()]
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as r:
+            previous = json.load(r)
+
+    document = OrderedDict()
+    document['environment'] = environment(args.url)
+    document['arguments'] = vars(args)
+    document['results'] = []
+    # well past anything seed.py makes, and different every run so reruns don't collide with leftovers
+    run = Run(args.rows, 10 ** 9 + int(time.time()) % 10 ** 6 * 1000)
+    for concurrency in levels:
+        for name in names:
+            result = run_scenario(
+                args.url, run, name, concurrency, args.duration, args.timeout, args.random_seed
+            )
+            document['results'].append(result)
+            print(json.dumps(result))
+
+    print_table(document['results'], previous)
+    cached = [r for r in document['results'] if r['cache_hits']]
+    if cached:
+        print(
+            'the response cache answered {} requests in {}, those latencies are mostly cache hits, '
+            'run the api with --cache-ttl 0 to measure the queries'.format(
+                sum(r['cache_hits'] for r in cached), sorted(set(r['scenario'] for r in cached))
+            )
+        )
+    output = args.output
+    if output is None:
+        if not os.path.isdir(CACHE_DIRPATH):
+            os.makedirs(CACHE_DIRPATH)
+        output = os.path.join(CACHE_DIRPATH, 'bench-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as w:
+        json.dump(document, w, indent=2)
+    print('wrote "{}"'.format(output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
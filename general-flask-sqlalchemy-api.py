@@ -33,33 +33,93 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 # stdlib imports
 from __future__ import print_function, absolute_import, division
 import os
+import re
 import sys
 import json
+import zlib
+import signal
+import socket
+import multiprocessing
+import base64
+import decimal
 import traceback
 import logging
 import datetime
+import functools
+import hashlib
+import pickle
+import threading
+import time
+import uuid
+import itertools
+import collections
+from operator import attrgetter
 import logging.handlers as l_handlers
 import argparse
+import random
+from timeit import default_timer
 from collections import OrderedDict
 try:
     # Python3
-    from urllib.parse import quote, quote_plus, unquote, unquote_plus
+    from urllib.parse import quote, quote_plus, unquote, unquote_plus, urlencode
 except ImportError:
     # Python2
-    from urllib import quote, quote_plus, unquote, unquote_plus
+    from urllib import quote, quote_plus, unquote, unquote_plus, urlencode
 
 # 3rd party imports
 import pyodbc
-from six import string_types
+from six import string_types, text_type
 from six.moves import configparser
-from flask import Flask, request, jsonify, send_from_directory
-from sqlalchemy import (create_engine, MetaData)
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context, has_request_context
+from werkzeug.serving import WSGIRequestHandler, make_server
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import (create_engine, event, MetaData, and_, or_, bindparam, false, func, select, text)
+from sqlalchemy import exc as sqlalchemy_exc
+from sqlalchemy.dialects import mssql
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import (sessionmaker, scoped_session)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.types import String
+from sqlalchemy.util import LRUCache
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional, the stdlib encoder does the same job slower
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # optional, gzip does the same job a bit bigger
+try:
+    import brotli
+except ImportError:
+    brotli = None  # optional, same
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None  # optional, only /api/v1/<resource>/_export needs it
+
+try:
+    from types import MappingProxyType as _frozen
+except ImportError:
+    _frozen = dict  # Python2, read only by convention then
 
 # globals
-ENGINE, SESSION_MAKER, BASE, METADATA = (None, None, None, None)
+ENGINE, SESSION_MAKER, SESSION, BASE, METADATA = (None, None, None, None, None)
+REGISTRY = _frozen({})  # lowercase table name -> TableDescriptor
+REGISTRY_LOCK = threading.Lock()
+TABLE_NAMES = _frozen({})  # lowercase table name -> real table name, for whatever lazy reflection hasn't gotten to yet
+REFLECT_MODE = 'eager'
+REPLICAS = ()  # Replica's to spread the reads over, ENGINE takes everything when there aren't any
+_REPLICA_TURN = itertools.count()
+SEARCH_INDEXES = {}  # lowercase table name -> lowercase column name -> SearchIndex, see --search-index
+CHANGE_FEEDS = {}  # lowercase table name -> ChangeFeed, see --changes
+WRITES = None  # write counters shared by the --workers, None when there's just the one process
+_WRITES_SEEN = None  # the counters as this worker last caught up on them
+RETIRING = False  # a worker on its way out, see run_worker
+PRIVILEGES = None  # PrivilegeLookup requests on a table get checked against, see --privileges, None lets all in
 
 # constants
 APP_NAME = os.path.splitext(os.path.basename(__file__))[0]
@@ -70,11 +130,83 @@ CACHE_DIRPATH = os.path.join(FILE_DIRPATH, 'ignoreme')
 LOG_FILEPATH = os.path.join(CACHE_DIRPATH, '{}.log'.format(APP_NAME))
 if not os.path.isdir(CACHE_DIRPATH):
     os.makedirs(CACHE_DIRPATH)
+NDJSON_MIMETYPE = 'application/x-ndjson'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+EXPORT_BATCH_SIZE = 65536  # rows per arrow record batch
+EXPORT_COMPRESSIONS = ['lz4', 'zstd']
+STREAM_BATCH_SIZE = 1000
+BULK_BATCH_SIZE = 1000
+MSSQL_MAX_PARAMETERS = 2100
+ON_CONFLICTS = ['error', 'update']
+WRITE_METHODS = ['POST', 'PUT', 'DELETE']
+RESPONSE_CACHE_ENTRIES = 1024
+RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_TTL = 5.0  # seconds, writes through the api invalidate right away, this is for everybody else's
+PERMISSIONS_TTL = 300.0
+PRIVILEGE_NAMES = ['SELECT', 'INSERT', 'UPDATE', 'DELETE']
+PRIVILEGE_MODES = ['auto', 'mssql', 'static', 'off']
+PRIVILEGES_TTL = 300.0
+PRIVILEGES_RETRY = 30.0  # seconds until another go after a refresh failed, the old privileges stand meanwhile
+METADATA_CACHE_KEY = ('_metadata', )
+PERMISSIONS_CACHE_KEY = ('_permissions', )
+ENCODINGS = [e for e, module in [('zstd', zstandard), ('br', brotli), ('gzip', zlib)] if module is not None]
+COMPRESS_MIN_BYTES = 1024  # smaller than this, the headers cost about as much as what compressing would save
+COMPRESS_MIMETYPES = ['application/json', 'application/x-ndjson', 'text/plain']
+# a cached document gets compressed once and sent many times, so it can afford to try harder
+COMPRESS_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+CACHED_COMPRESS_LEVELS = {'zstd': 12, 'br': 9, 'gzip': 9}
+PROJECTION_CACHE_SIZE = 64  # per table, plenty for the handful of fields= combos a client actually uses
+STATEMENT_CACHE_SIZE = 256  # per table, one per shape of GET
+COMPILED_CACHE_SIZE = 2048
+FILTER_OPS = ['eq', 'ne', 'gt', 'ge', 'lt', 'le', 'in', 'nin', 'between', 'like', 'ilike', 'prefix', 'null']
+LIKE_OPS = ['like', 'ilike', 'prefix']
+AGGREGATES = ['count', 'sum', 'min', 'max', 'avg']
+DATETIME_FORMATS = [
+    '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'
+]
+TIME_FORMATS = ['%H:%M:%S.%f', '%H:%M:%S', '%H:%M']
+JSON_BACKENDS = ['orjson', 'json']
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+STATS_NAMESPACE = 'generic_api'
+STATS_SAMPLE_RATE = 1.0  # fraction of requests that get timed
+STATS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+STATS_QUANTILES = (0.5, 0.95, 0.99)
+SERVER_TIMING = False
 SQLA_FMT = 'mssql+pyodbc://{uid}:{pwd}@{host}:{port}/{name}?driver={driver}'
 SQLA_FMT_TRUSTED = 'mssql+pyodbc://{host}:{port}/{name}?trusted_connection={trusted_connection}&driver={driver}'
 MSSQL_PERMISSIONS = '''
 EXEC sp_table_privileges @table_name = '%', @table_owner = 'dbo'
 '''
+MSSQL_PRIVILEGES = '''
+SELECT o.name, p.privilege
+FROM sys.objects o JOIN sys.schemas s ON s.schema_id = o.schema_id
+CROSS JOIN (VALUES ('SELECT'), ('INSERT'), ('UPDATE'), ('DELETE')) p (privilege)
+WHERE o.type IN ('U', 'V') AND s.name = COALESCE(:schema, SCHEMA_NAME())
+AND HAS_PERMS_BY_NAME(QUOTENAME(s.name) + '.' + QUOTENAME(o.name), 'OBJECT', p.privilege) = 1
+'''
+MSSQL_FINGERPRINT = '''
+SELECT COUNT(*), MAX(o.modify_date), CHECKSUM_AGG(CHECKSUM(o.object_id, o.modify_date))
+FROM sys.objects o JOIN sys.schemas s ON s.schema_id = o.schema_id
+WHERE o.type IN ('U', 'V') AND s.name = COALESCE(:schema, SCHEMA_NAME())
+'''
+SQLITE_FINGERPRINT = '''
+SELECT type, name, sql FROM sqlite_master ORDER BY type, name
+'''
+REFLECT_MODES = ['eager', 'lazy', 'cache']
+READ_YOUR_WRITES = 5.0  # seconds a client reads from the primary after it writes, so it sees what it wrote
+READ_YOUR_WRITES_COOKIE = 'read_your_writes'
+REPLICA_RETRY = 30.0  # seconds a replica sits out after it failed to connect
+BATCH_MAX_OPERATIONS = 1000
+SEARCH_MAX_KEYS = MSSQL_MAX_PARAMETERS - 100  # past this many matches a search goes back to LIKE
+CHANGES_LIMIT = 1000  # rows a _changes page gets when it doesn't say
+CHANGES_MAX_WAIT = 30.0
+CHANGES_POLL = 1.0  # seconds between looks at the table while long polling, for writes that went around this process
+CHANGES_TOMBSTONES = 100000  # deletes remembered per table
+WRITE_SLOTS = 256  # tables hash into these, two sharing one just invalidate each other now and then
+WORKER_GRACE = 30.0  # seconds a worker gets to finish what it's doing before it gets killed
+WORKER_KEEPALIVE = 5.0  # seconds an idle keep-alive connection holds onto a worker thread
+BATCH_ENDPOINTS = ['generic_endpoint', 'aggregate_endpoint']
+BATCH_HEADERS = ['ETag', 'Link', 'X-Next-Cursor', 'X-Prev-Cursor', 'X-Total-Count']
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
@@ -91,57 +223,554 @@ app.logger.addHandler(_file_hndl)
 werkzeug_logger.addHandler(_file_hndl)
 
 
+def json_default(obj):
+    # whatever wasn't already turned into something json knows, rows mostly get converted before they get here
+    if isinstance(obj, datetime.datetime):
+        return str(obj)  # the microsecond format is what I want
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)  # floats would quietly eat the precision
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(obj)).decode('ascii')
+    try:
+        return list(iter(obj))  # covers sets
+    except TypeError:
+        pass
+    raise TypeError('Object of type {} is not JSON serializable'.format(obj.__class__.__name__))
+
+
 class CustomJSONEncoder(json.JSONEncoder):
     # https://stackoverflow.com/a/43663918
     def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return str(obj)  # the microsecond format is what I want
-        try:
-            iterable = iter(obj)
-            return json.JSONEncoder.default(self, list(iterable))  # covers sets
-        except TypeError:
-            pass
-        return json.JSONEncoder.default(self, obj)
+        return json_default(obj)
 
 
 app.json_encoder = CustomJSONEncoder
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'), default=json_default)
+_row_dict = dict if sys.version_info >= (3, 7) else OrderedDict  # dicts keep their order from 3.7 on, and build faster
+if orjson is not None:
+    # datetimes go through json_default too, orjson would put a T in them that the stdlib path doesn't
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def dumps(obj):
+    # type: (object) -> bytes
+    # compact json as bytes, through orjson when it's around and allowed
+    if JSON_BACKEND == 'orjson':
+        try:
+            return orjson.dumps(obj, default=json_default, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            pass  # ints past 64 bits and such, the stdlib copes
+    return _JSON_ENCODER.encode(obj).encode('utf-8')
 
 
 def stack_it_up(
-    connection_string, isolation_level='READ UNCOMMITTED', schema='dbo', autoflush=True, pool_size=5, max_overflow=0
+    connection_string,
+    isolation_level='READ UNCOMMITTED',
+    schema='dbo',
+    autoflush=True,
+    pool_size=5,
+    max_overflow=0,
+    reflect='eager',
+    fast_executemany=True,
+    pool_recycle=60,
+    pool_pre_ping=False,
+    pool_timeout=30,
+    replicas=None
 ):
     # https://docs.sqlalchemy.org/en/13/core/pooling.html#disconnect-handling-optimistic
     # https://stackoverflow.com/questions/29905160/automap-reflect-tables-within-a-postgres-schema-with-sqlalchemy
     # https://stackoverflow.com/questions/29905160/automap-reflect-tables-within-a-postgres-schema-with-sqlalchemy
-    global ENGINE, SESSION_MAKER, BASE, METADATA
+    # replicas is [(name, connection_string, pool kwargs like the ones above), ...], see parse_config
+    global ENGINE, SESSION_MAKER, SESSION, BASE, METADATA, REGISTRY, TABLE_NAMES, REFLECT_MODE, REPLICAS
+    if reflect not in REFLECT_MODES:
+        raise ValueError('reflect not in {}'.format(REFLECT_MODES))
+    started = time.time()
 
     if ENGINE is None:
-        ENGINE = create_engine(
+        ENGINE = make_engine(
             connection_string,
-            isolation_level=isolation_level,
-            pool_recycle=60,
+            isolation_level,
+            fast_executemany,
+            pool_recycle=pool_recycle,
             pool_size=pool_size,
-            max_overflow=max_overflow
+            max_overflow=max_overflow,
+            pool_pre_ping=pool_pre_ping,
+            pool_timeout=pool_timeout
+        )
+        # each replica gets a pool of its own, so reads piling up on one can't starve the writes on the primary
+        REPLICAS = tuple(
+            Replica(name, make_engine(cnxn_str, isolation_level, fast_executemany, **pool_kwargs))
+            for name, cnxn_str, pool_kwargs in replicas or []
         )
 
     if SESSION_MAKER is None:
         SESSION_MAKER = sessionmaker(bind=ENGINE, autoflush=autoflush)
+        SESSION = scoped_session(SESSION_MAKER)
 
     if BASE is None or METADATA is None:
-        METADATA = MetaData(schema=schema)
-        BASE = automap_base(bind=ENGINE, metadata=METADATA)
-        BASE.prepare(ENGINE, reflect=True)
+        REFLECT_MODE = reflect
+        BASE, METADATA, REGISTRY, TABLE_NAMES = reflect_schema(schema, reflect)
 
+    app.logger.info(
+        'stacked up {} tables ({} known) with {} reflection in {:.3f}s'.format(
+            len(REGISTRY), len(known_tables()), REFLECT_MODE, time.time() - started
+        )
+    )
 
-def get_session():
-    if SESSION_MAKER is None:
+
+def reflect_schema(schema, mode):
+    # type: (str, str) -> tuple
+    table_names = OrderedDict()
+    if mode == 'lazy':
+        # just the names, one cheap catalog query, each table gets reflected the first time somebody asks for it
+        metadata = MetaData(schema=schema)
+        for name in inspect(ENGINE).get_table_names(schema=schema):
+            table_names[name.lower()] = name
+        base = automap_base(bind=ENGINE, metadata=metadata)
+    elif mode == 'cache':
+        metadata = load_metadata_snapshot(schema)
+        base = automap_base(bind=ENGINE, metadata=metadata)
+        base.prepare()
+    else:
+        metadata = MetaData(schema=schema)
+        base = automap_base(bind=ENGINE, metadata=metadata)
+        base.prepare(ENGINE, reflect=True)
+    return base, metadata, build_registry(base), _frozen(table_names)
+
+
+def make_engine(connection_string, isolation_level, fast_executemany, **pool_kwargs):
+    kwargs = dict(poolclass=TimedQueuePool, **pool_kwargs)
+    if connection_string.startswith('sqlite'):
+        # the pool class keeps sqlite from getting one that won't take any sizing, it just can't cross threads
+        kwargs.update(connect_args={'check_same_thread': False})
+    if connection_string.startswith('mssql+pyodbc'):
+        # pyodbc ships the whole executemany in one go instead of a round trip a row
+        kwargs.update(fast_executemany=fast_executemany)
+    engine = create_engine(connection_string, isolation_level=isolation_level, **kwargs)
+    watch_pool(engine)
+    return engine
+
+
+def dispose_engines():
+    # connections don't survive a fork, so every process starts over with pools of its own
+    ENGINE.dispose()
+    for replica in REPLICAS:
+        replica.engine.dispose()
+
+
+def reflect_tables(names, bind=None):
+    # type: (list, object) -> list
+    # lazy reflection; each batch gets its own automap base so nothing thats already mapped gets mapped twice.
+    # bind is just who answers the catalog queries, a replica will do
+    global REGISTRY
+    with REGISTRY_LOCK:
+        missing = [name for name in names if name.lower() not in REGISTRY]
+        if missing:
+            started = time.time()
+            metadata = MetaData(schema=METADATA.schema)
+            metadata.reflect(bind or ENGINE, only=missing)
+            base = automap_base(bind=ENGINE, metadata=metadata)
+            base.prepare()
+            registry = OrderedDict(REGISTRY)
+            for name in missing:
+                if not hasattr(base.classes, name):
+                    raise RuntimeError('{!r} has no primary key, automap cannot map it.'.format(name))
+                registry[name.lower()] = TableDescriptor(name, getattr(base.classes, name))
+            REGISTRY = _frozen(registry)
+            app.logger.info('lazily reflected {} in {:.3f}s'.format(missing, time.time() - started))
+        return [REGISTRY[name.lower()] for name in names]
+
+
+def schema_fingerprint(schema):
+    # type: (str) -> str
+    # has to be way cheaper than reflecting, otherwise whats the point
+    with ENGINE.connect() as connection:
+        if ENGINE.dialect.name == 'sqlite':
+            rows = connection.execute(SQLITE_FINGERPRINT).fetchall()
+        elif ENGINE.dialect.name == 'mssql':
+            rows = connection.execute(text(MSSQL_FINGERPRINT), schema=schema).fetchall()
+        else:  # only catches tables coming and going, not columns changing
+            rows = sorted(inspect(connection).get_table_names(schema=schema))
+    return hashlib.sha1(repr([tuple(row) for row in rows]).encode('utf-8')).hexdigest()
+
+
+def metadata_snapshot_filepath(schema):
+    # type: (str) -> str
+    digest = hashlib.sha1('{!r}|{}'.format(ENGINE.url, schema).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(CACHE_DIRPATH, '{}.metadata.{}.pickle'.format(APP_NAME, digest))
+
+
+def load_metadata_snapshot(schema):
+    # type: (str) -> MetaData
+    filepath = metadata_snapshot_filepath(schema)
+    fingerprint = schema_fingerprint(schema)
+    if os.path.isfile(filepath):
+        try:
+            with open(filepath, 'rb') as r:
+                cached_fingerprint, metadata = pickle.load(r)
+            if cached_fingerprint == fingerprint:
+                app.logger.info('schema snapshot "{}" is fresh'.format(filepath))
+                return metadata
+            app.logger.info('schema snapshot "{}" is stale, reflecting everything'.format(filepath))
+        except Exception:
+            app.logger.exception('schema snapshot "{}" is busted, reflecting everything'.format(filepath))
+
+    metadata = MetaData(schema=schema)
+    metadata.reflect(ENGINE)
+    temp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+    with open(temp_filepath, 'wb') as w:
+        pickle.dump((fingerprint, metadata), w, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filepath, filepath)  # so a half written snapshot never gets read
+    app.logger.info('schema snapshot "{}" written'.format(filepath))
+    return metadata
+
+
+def get_session(bind=None):
+    # bind only counts for the first session of a request, it can't change engines halfway through
+    if SESSION is None:
         raise RuntimeError('session maker needs to be created first dude...')
-    return scoped_session(SESSION_MAKER)
+    if bind is not None and not SESSION.registry.has():
+        return SESSION(bind=bind)
+    return SESSION
+
+
+class Replica(object):
+    # a read only engine, and whether its been answering lately
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        self.down_until = 0.0
+        self.failures = 0
+
+        @event.listens_for(engine, 'handle_error')
+        def _failed(context):
+            # no connection means it never got one, which is the kind of trouble that'll happen again
+            if context.is_disconnect or context.connection is None:
+                self.fail()
+                if has_request_context():
+                    g.replica_failed = True  # see retries_on_primary
+
+    def fail(self):
+        self.failures += 1
+        self.down_until = time.time() + REPLICA_RETRY
+        app.logger.warning('replica {!r} is sitting out the next {}s'.format(self.name, REPLICA_RETRY))
+
+    def snapshot(self):
+        # type: () -> OrderedDict
+        dick = self.engine.pool.stats.snapshot(self.engine.pool)
+        dick['healthy'] = self.down_until <= time.time()
+        dick['failures'] = self.failures
+        return dick
+
+
+def read_engine():
+    # round robin over the replicas that haven't failed lately, the primary when none are left,
+    # or when this client just wrote something and has to be able to read it back
+    if not REPLICAS or wrote_recently() or (has_request_context() and g.get('primary_only')):
+        return ENGINE
+    now = time.time()
+    turn = next(_REPLICA_TURN)
+    for i in range(len(REPLICAS)):
+        replica = REPLICAS[(turn + i) % len(REPLICAS)]
+        if replica.down_until <= now:
+            return replica.engine
+    return ENGINE
+
+
+def retries_on_primary(view):
+    # a read that took its replica down with it gets one more go on the primary, so a replica going away costs
+    # a bit of latency instead of errors. a stream that already started can't be taken back, that one still fails
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.replica_failed = False
+        try:
+            response = view(*args, **kwargs)
+        except Exception:
+            if not g.replica_failed:
+                raise
+        else:
+            if not g.replica_failed:
+                return response
+        app.logger.warning('{} {} failed on a replica, once more on the primary'.format(request.method, request.path))
+        SESSION.remove()  # the session is still bound to the replica
+        g.primary_only = True
+        g.replica_failed = False
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def wrote_recently():
+    # type: () -> bool
+    if not has_request_context():
+        return False
+    try:
+        return float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def lagging(engine, tag):
+    # type: (object, str) -> bool
+    # a replica that read right after a write to the table might not have the write yet, and caching
+    # that would hand the old rows to everybody, so only the primary's reads get cached for a bit
+    return engine is not ENGINE and RESPONSE_CACHE.invalidated_within(tag, READ_YOUR_WRITES)
+
+
+@app.after_request
+def remember_writes(response):
+    # a _batch of nothing but reads says so through g.wrote
+    if REPLICAS and READ_YOUR_WRITES > 0 and request.method in WRITE_METHODS and g.get('wrote', True):
+        expires = time.time() + READ_YOUR_WRITES
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE, '{:.3f}'.format(expires), max_age=int(READ_YOUR_WRITES) + 1, httponly=True
+        )
+    return response
+
+
+class PrivilegeLookup(object):
+    # (table, privilege) pairs compiled out of a provider once, so checking a request is a set lookup instead of
+    # finding out from the database halfway through a transaction. refreshed every ttl seconds by whichever
+    # request notices first, everybody else goes on with the old ones meanwhile
+    def __init__(self, provider, ttl=PRIVILEGES_TTL):
+        self.provider = provider  # anything with a load() that returns (table, privilege)s, '*' for every table
+        self.ttl = ttl
+        self.allowed = None
+        self.expires = 0.0
+        self.lock = threading.Lock()
+        self.refreshes = 0
+        self.failures = 0
+        self.denials = 0
+
+    def refresh(self):
+        # type: () -> int
+        allowed = frozenset((table.lower(), privilege.upper()) for table, privilege in self.provider.load())
+        self.allowed, self.expires = allowed, time.time() + self.ttl
+        self.refreshes += 1
+        return len(allowed)
+
+    def allows(self, table, privilege):
+        # type: (str, str) -> bool
+        if self.expires <= time.time():
+            self._expired()
+        allowed = self.allowed
+        return (table, privilege) in allowed or ('*', privilege) in allowed
+
+    def _expired(self):
+        # the first load everybody waits on, there's nothing to go by until then
+        if not self.lock.acquire(self.allowed is None):
+            return
+        try:
+            if self.expires <= time.time():
+                try:
+                    self.refresh()
+                except Exception:
+                    self.failures += 1
+                    if self.allowed is None:
+                        raise  # and nothing gets through
+                    self.expires = time.time() + PRIVILEGES_RETRY
+                    app.logger.exception('privileges did not refresh, the old ones stand for {}s'.format(
+                        PRIVILEGES_RETRY))
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        # type: () -> OrderedDict
+        return OrderedDict([
+            ('grants', len(self.allowed or ())), ('refreshes', self.refreshes), ('failures', self.failures),
+            ('denials', self.denials)
+        ])
+
+
+class MssqlPrivileges(object):
+    # what the login the api connects as can actually do. sp_table_privileges (see /permissions) lists every
+    # grantee and knows nothing of roles or denies, HAS_PERMS_BY_NAME works all of that out on the server
+    def __init__(self, engine, schema):
+        self.engine = engine
+        self.schema = schema
+
+    def load(self):
+        # type: () -> list
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(text(MSSQL_PRIVILEGES), schema=self.schema)]
+
+
+class StaticPrivileges(object):
+    # a fixed policy out of the config's [privileges], for sqlite and anything else without grants to ask about
+    def __init__(self, grants):
+        # type: (dict) -> None
+        self.grants = grants  # table or '*' -> privileges, see parse_privileges
+
+    def load(self):
+        # type: () -> list
+        return [(table, privilege) for table, privileges in self.grants.items() for privilege in privileges]
+
+
+def privilege_provider(mode, grants, engine, schema):
+    # type: (str, dict, object, str) -> object
+    # auto is the config's [privileges] when there is one, the database's own on mssql, nothing otherwise
+    if mode not in PRIVILEGE_MODES:
+        raise ValueError('--privileges not in {}'.format(PRIVILEGE_MODES))
+    if mode == 'auto':
+        mode = 'static' if grants is not None else 'mssql' if engine.dialect.name == 'mssql' else 'off'
+    if mode == 'off':
+        return None
+    if mode == 'static':
+        if grants is None:
+            raise ValueError('--privileges static needs a [privileges] section in the config')
+        return StaticPrivileges(grants)
+    if engine.dialect.name != 'mssql':
+        raise ValueError('--privileges mssql needs a mssql database, not {}'.format(engine.dialect.name))
+    return MssqlPrivileges(engine, schema)
+
+
+def required_privileges(endpoint, method, args):
+    # type: (str, str, dict) -> list
+    # what the database would want for what the request runs. PUT and DELETE read the columns their WHERE looks
+    # at, and so does an upsert looking for the keys that are already there
+    if endpoint != 'generic_endpoint' or method not in WRITE_METHODS:
+        return ['SELECT']
+    if method == 'POST':
+        if str(args.get('on_conflict') or '').lower() == 'update':
+            return ['SELECT', 'INSERT', 'UPDATE']
+        return ['INSERT']
+    if _parse_flag(args.get('dry_run', None)):
+        return ['SELECT']
+    return ['SELECT', 'UPDATE' if method == 'PUT' else 'DELETE']
+
+
+def privilege_denied(endpoint, method, view_args, args):
+    # type: (str, str, dict, dict) -> tuple
+    # (status, error) for a request the database would turn down anyway, None to go ahead
+    if PRIVILEGES is None or 'resource' not in (view_args or {}):
+        return None
+    resource = view_args['resource']
+    try:
+        missing = [
+            p for p in required_privileges(endpoint, method, args) if not PRIVILEGES.allows(resource.lower(), p)
+        ]
+    except Exception as e:
+        app.logger.exception('privileges did not load')
+        return 503, 'privileges could not be loaded: {}'.format(e)
+    if not missing:
+        return None
+    PRIVILEGES.denials += 1
+    return 403, '{} on {!r} needs {}, which is not granted'.format(method, resource, missing)
+
+
+@app.before_request
+def enforce_privileges():
+    # before there's a session, never mind a query
+    if PRIVILEGES is None or request.url_rule is None:
+        return None
+    denied = privilege_denied(request.url_rule.endpoint, request.method, request.view_args, request.args)
+    if denied is not None:
+        status, error = denied
+        return jsonify(error=error), status
+    return None
+
+
+COMPILED_CACHE = LRUCache(COMPILED_CACHE_SIZE)
+
+
+def execute_cached(session, statement, params):
+    # statements out of a TableDescriptor's cache are the same objects every time, which is what sqlalchemy's
+    # compiled_cache goes by, so their sql only ever gets compiled once
+    return session.connection().execution_options(compiled_cache=COMPILED_CACHE).execute(statement, params)
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    # every request hands its connection back, whatever happened, streamed responses included once they're done
+    if SESSION is not None:
+        SESSION.remove()
+
+
+class PoolStats(object):
+    # what the pool can't say about itself: how long checkouts waited, and how often things went wrong
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+
+    def waited(self, seconds, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def count(self, attr):
+        with self.lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def snapshot(self, pool):
+        # type: (QueuePool) -> OrderedDict
+        with self.lock:
+            return OrderedDict(
+                [
+                    ('size', pool.size()),
+                    ('checked_out', pool.checkedout()),
+                    ('idle', pool.checkedin()),
+                    ('overflow', pool.overflow()),
+                    ('checkouts', self.checkouts),
+                    ('timeouts', self.timeouts),
+                    ('wait_seconds_total', round(self.wait_seconds, 6)),
+                    ('wait_seconds_mean', round(self.wait_seconds / self.checkouts, 6) if self.checkouts else 0.0),
+                    ('wait_seconds_max', round(self.max_wait_seconds, 6)),
+                    ('connects', self.connects),
+                    ('invalidations', self.invalidations),
+                ]
+            )
+
+
+class TimedQueuePool(QueuePool):
+    # a QueuePool that times how long each checkout sat in the queue, there's no pool event for that
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except sqlalchemy_exc.TimeoutError:
+            self.stats.waited(time.time() - started, timed_out=True)
+            raise
+        self.stats.waited(time.time() - started)
+        return connection
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.stats = self.stats  # dispose() recreates the pool, the numbers should survive that
+        return pool
+
+
+# sqlalchemy names a pool's logger after its class, which would put this one under the app's DEBUG logger
+logging.getLogger('{}.{}'.format(__name__, TimedQueuePool.__name__)).setLevel(logging.WARNING)
+
+
+def watch_pool(engine):
+    stats = engine.pool.stats
+    event.listen(engine, 'connect', lambda *args: stats.count('connects'))
+    event.listen(engine, 'invalidate', lambda *args: stats.count('invalidations'))
+    event.listen(engine, 'soft_invalidate', lambda *args: stats.count('invalidations'))
 
 
 class MsSqlOdbc(object):
     # [odbc]
-    KEYS = ['driver', 'server', 'instance', 'database', 'port', 'username', 'password', 'trusted_connection']
+    KEYS = [
+        'driver', 'server', 'instance', 'database', 'port', 'username', 'password', 'trusted_connection', 'schema',
+        'connection_string', 'pool_size', 'max_overflow', 'pool_recycle', 'pool_pre_ping', 'pool_timeout'
+    ]
     driver = 'SQL Server'
     server = 'localhost'
     instance = 'SQLEXPRESS'
@@ -150,8 +779,34 @@ class MsSqlOdbc(object):
     username = 'username'
     password = 'password123'
     trusted_connection = 0
+    schema = 'dbo'
+    connection_string = None  # anything sqlalchemy understands, trumps everything above but the schema
+    pool_size = 5
+    max_overflow = 0
+    pool_recycle = 60  # seconds
+    pool_pre_ping = 0
+    pool_timeout = 30  # seconds a request waits on a connection before giving up
+    section = 'odbc'  # or odbc:<name> for a replica
+    replicas = ()
+    privileges = None  # [privileges], see parse_privileges
+
+    @property
+    def name(self):
+        return self.section.partition(':')[2] or 'primary'
+
+    def get_pool_kwargs(self):
+        return dict(
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_recycle=self.pool_recycle,
+            pool_pre_ping=bool(self.pool_pre_ping),
+            pool_timeout=self.pool_timeout
+        )
 
     def get_connection_string(self):
+        if self.connection_string:
+            app.logger.info(repr(make_url(self.connection_string)))  # the repr hides the password
+            return self.connection_string
         if self.trusted_connection:
             cnxn_str = SQLA_FMT_TRUSTED.format(
                 host=self.server,
@@ -185,27 +840,85 @@ class MsSqlOdbc(object):
         dick = OrderedDict()
         for key in self.__class__.KEYS:
             dick[key] = getattr(self, key)
-        return '[odbc]\n{}'.format('\n'.join('{}={}'.format(k, '' if v is None else v) for k, v in dick.items()))
+        return '[{}]\n{}'.format(
+            self.section, '\n'.join('{}={}'.format(k, '' if v is None else v) for k, v in dick.items())
+        )
 
 
 def parse_config(ini_filepath):
     # type: (str) -> MsSqlOdbc
+    # [odbc] is the primary, every [odbc:<name>] is a read replica of it
     parser = configparser.ConfigParser()
     parser.read(ini_filepath)
-    # [odbc]
-    driver = parser.get('odbc', 'driver')
+    o = parse_section(parser, 'odbc')
+    o.replicas = [parse_section(parser, section) for section in parser.sections() if section.startswith('odbc:')]
+    o.privileges = parse_privileges(parser) if parser.has_section('privileges') else None
+    return o
+
+
+def parse_privileges(parser):
+    # type: (configparser.ConfigParser) -> OrderedDict
+    # [privileges] is <table>=select,insert,... or all, * for every table, an empty one for nothing at all
+    grants = OrderedDict()
+    for table, value in parser.items('privileges'):
+        privileges = [p.strip().upper() for p in value.split(',') if p.strip()]
+        if privileges == ['ALL']:
+            privileges = list(PRIVILEGE_NAMES)
+        for privilege in privileges:
+            if privilege not in PRIVILEGE_NAMES:
+                raise ValueError('[privileges] {}={} has to be from {} or ALL'.format(table, value, PRIVILEGE_NAMES))
+        grants[table.lower()] = privileges
+    return grants
+
+
+def _config_get(parser, section, key):
+    # type: (configparser.ConfigParser, str, str) -> str
+    # replicas take whatever they don't say from [odbc], except for where to connect
+    if section == 'odbc' or key == 'connection_string' or parser.has_option(section, key):
+        return parser.get(section, key)
+    return parser.get('odbc', key)
+
+
+def _config_has(parser, section, key):
+    # type: (configparser.ConfigParser, str, str) -> bool
+    if section == 'odbc' or key == 'connection_string':
+        return parser.has_option(section, key)
+    return parser.has_option(section, key) or parser.has_option('odbc', key)
+
+
+def parse_section(parser, section):
+    # type: (configparser.ConfigParser, str) -> MsSqlOdbc
+    get = functools.partial(_config_get, parser, section)
+    schema = get('schema') if _config_has(parser, section, 'schema') else None
+    if schema == '':
+        schema = None
+    pool = parse_pool_options(parser, section)
+    connection_string = ''
+    if _config_has(parser, section, 'connection_string'):
+        connection_string = get('connection_string')
+    if connection_string != '':
+        # mostly so a sqlite file can stand in for the real thing, which has no dbo
+        o = MsSqlOdbc()
+        o.section = section
+        o.connection_string = connection_string
+        o.schema = schema
+        for k, v in pool.items():
+            setattr(o, k, v)
+        return o
+
+    driver = get('driver')
     if driver not in pyodbc.drivers():
         raise ValueError('"{}" not in legal drivers: {}'.format(driver, pyodbc.drivers()))
-    server = parser.get('odbc', 'server')
+    server = get('server')
     if server == '':
         raise ValueError('server cannot be None!')
-    instance = parser.get('odbc', 'instance')
+    instance = get('instance')
     if instance == '':
         instance = server
-    database = parser.get('odbc', 'database')
+    database = get('database')
     if database == '':
         raise ValueError('database cannot be None!')
-    port = parser.get('odbc', 'port')
+    port = get('port')
     if port == '':
         raise ValueError('port cannot be None!')
     try:
@@ -213,7 +926,7 @@ def parse_config(ini_filepath):
     except ValueError:
         raise ValueError('port must be an int!')
 
-    trusted_connection = parser.get('odbc', 'trusted_connection')
+    trusted_connection = get('trusted_connection')
     if trusted_connection == '':
         trusted_connection = False
     try:
@@ -225,14 +938,15 @@ def parse_config(ini_filepath):
         trusted_connection = bool(trusted_connection)
     except ValueError:
         raise ValueError('trusted_connection must be a bool!')
-    username = parser.get('odbc', 'username')
+    username = get('username')
     if username == '' and not trusted_connection:
         raise ValueError('username cannot be None!')
-    password = parser.get('odbc', 'password')
+    password = get('password')
     if password == '' and not trusted_connection:
         raise ValueError('password cannot be None!')
 
     o = MsSqlOdbc()
+    o.section = section
     o.driver = driver
     o.server = server
     o.instance = instance
@@ -241,23 +955,68 @@ def parse_config(ini_filepath):
     o.username = username
     o.password = password
     o.trusted_connection = trusted_connection
+    o.schema = MsSqlOdbc.schema if schema is None else schema
+    for k, v in pool.items():
+        setattr(o, k, v)
     return o
 
 
+def parse_pool_options(parser, section):
+    # type: (configparser.ConfigParser, str) -> OrderedDict
+    # all optional, whatever isn't there keeps the MsSqlOdbc default
+    get = functools.partial(_config_get, parser, section)
+    pool = OrderedDict()
+    for key, cast in [('pool_size', int), ('max_overflow', int), ('pool_recycle', int), ('pool_timeout', float)]:
+        if _config_has(parser, section, key) and get(key) != '':
+            try:
+                pool[key] = cast(get(key))
+            except ValueError:
+                raise ValueError('{} must be a number!'.format(key))
+    if _config_has(parser, section, 'pool_pre_ping') and get('pool_pre_ping') != '':
+        pre_ping = get('pool_pre_ping').lower()
+        if pre_ping not in ['1', 'yes', 'true', 'on', '0', 'no', 'false', 'off']:
+            raise ValueError('pool_pre_ping must be a bool!')
+        pool['pool_pre_ping'] = pre_ping in ['1', 'yes', 'true', 'on']
+    if pool.get('pool_size', 1) < 1 or pool.get('max_overflow', 0) < -1:
+        raise ValueError('pool_size has to be at least 1 and max_overflow at least -1 (unlimited)!')
+    return pool
+
+
 class QueryParams(object):
     search = None
     search_key = None
+    search_indexed = None  # None until resolve_search had a look
+    search_keys = None
     order = None
     order_key = None
     offset = None
     limit = None
+    cursor = None
+    filters = ()
+    aggregates = ()
+    group_by = ()
+    total = False
+    stream = False
+    fields = None
+    dry_run = False
+    all_rows = False
+    batch_size = BULK_BATCH_SIZE
+    on_conflict = 'error'
+
+    def cache_key(self):
+        # only what changes the rows that come back
+        return (
+            self.search, self.search_key, self.order, self.order_key, self.offset, self.limit, self.cursor,
+            None if self.fields is None else tuple(self.fields), self.filters, self.aggregates, self.group_by,
+            self.total
+        )
 
 
 def parse_query_params():
     # type: () -> QueryParams
 
     # where id > 1234
-    offset = request.args.get('offset', -1)
+    offset = request.args.get('offset', None)
     if offset == '':
         offset = -1
     elif offset is not None:
@@ -280,6 +1039,9 @@ def parse_query_params():
     if (search is not None and search_key is None) or (search_key is not None and search is None):
         raise RuntimeError('you must provide search and search_key at the same time!')
 
+    # where age > 30 and status in ('a', 'b'), see parse_filter, more than one filter= get and'd together
+    filters = tuple(parse_filter(f) for f in request.args.getlist('filter') if f != '')
+
     # order by <order_key>
     order_key = request.args.get('order_key', None)
     if order_key == '':
@@ -292,7 +1054,7 @@ def parse_query_params():
         order = 'asc'
     elif order is not None:
         order = order.lower()
-    if order not in ['asc', 'desc']:
+    if order is not None and order not in ['asc', 'desc']:
         raise ValueError('order not in {}'.format(['asc', 'desc']))
     if (order is not None and order_key is None) or (order_key is not None and order is None):
         raise RuntimeError('you must provide order and order_key at the same time!')
@@ -307,33 +1069,1743 @@ def parse_query_params():
         else:
             limit = int(limit)
 
+    # where (<order_key>, <primary keys...>) > (<values from the cursor>)
+    cursor = request.args.get('cursor', None)
+    if cursor == '':
+        cursor = None
+
+    # a COUNT(*) over the same filters in X-Total-Count, whatever page this is
+    total = _parse_flag(request.args.get('total', None))
+
+    # select <group_by>, count(*), sum(<key>) ... group by <group_by>, only /_aggregate looks at these
+    aggregates = []
+    for name in AGGREGATES:
+        value = request.args.get(name, None)
+        if value:
+            aggregates.extend((name, k.strip().lower()) for k in value.split(',') if k.strip())
+    aggregates = tuple(OrderedDict.fromkeys(aggregates))
+    group_by = request.args.get('group_by', None) or ''
+    group_by = tuple(OrderedDict.fromkeys(k.strip().lower() for k in group_by.split(',') if k.strip()))
+
+    # one json object per line, written out as the rows come off the cursor
+    stream = request.args.get('stream', None)
+    if stream is None or stream == '':
+        stream = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+    else:
+        stream = _parse_flag(stream)
+
+    # bulk PUT and DELETE, count instead of write, and say so when no filter is meant to hit every row
+    dry_run = _parse_flag(request.args.get('dry_run', None))
+    all_rows = _parse_flag(request.args.get('all', None))
+
+    # select <fields> instead of select *
+    fields = request.args.get('fields', None)
+    if fields == '':
+        fields = None
+    if isinstance(fields, string_types):
+        fields = [f.strip() for f in unquote(str(fields)).lower().split(',') if f.strip()]
+        fields = list(OrderedDict.fromkeys(fields)) or None
+
+    # bulk POSTs, how many rows per executemany and what to do when the primary key is already there
+    batch_size = request.args.get('batch_size', None)
+    if batch_size is None or batch_size == '':
+        batch_size = BULK_BATCH_SIZE
+    else:
+        batch_size = int(batch_size)
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1!')
+    on_conflict = request.args.get('on_conflict', None)
+    if on_conflict is None or on_conflict == '':
+        on_conflict = 'error'
+    else:
+        on_conflict = on_conflict.lower()
+    if on_conflict not in ON_CONFLICTS:
+        raise ValueError('on_conflict not in {}'.format(ON_CONFLICTS))
+
     q = QueryParams()
     q.search = search
     q.search_key = search_key
+    q.filters = filters
     q.order = order
     q.order_key = order_key
     q.offset = offset
     q.limit = limit
+    q.cursor = cursor
+    q.total = total
+    q.aggregates = aggregates
+    q.group_by = group_by
+    q.stream = stream
+    q.fields = fields
+    q.batch_size = batch_size
+    q.on_conflict = on_conflict
+    q.dry_run = dry_run
+    q.all_rows = all_rows
     return q
 
 
+def _parse_flag(value):
+    # type: (str) -> bool
+    return value is not None and str(value).lower() in ['1', 'true', 'yes']
+
+
+def parse_filter(text):
+    # type: (str) -> tuple
+    # "age:gt:30,status:in:a|b;name:prefix:bob" is (age > 30 and status in ('a', 'b')) or name like 'bob%'.
+    # a backslash escapes any of ,;:| that belong in a value. comes back as or'd groups of and'd (key, op, values)
+    groups = []
+    for group in _split_unescaped(text, ';'):
+        clauses = []
+        for clause in _split_unescaped(group, ','):
+            if not clause.strip():
+                continue
+            parts = _split_unescaped(clause, ':', 2)
+            if len(parts) != 3:
+                raise ValueError('filters look like "key:op:value", got {!r}'.format(clause))
+            key, op, value = _unescape(parts[0]).strip().lower(), parts[1].strip().lower(), parts[2]
+            if op not in FILTER_OPS:
+                raise ValueError('{!r} not in {}'.format(op, FILTER_OPS))
+            if op in ['in', 'nin', 'between']:
+                values = tuple(_unescape(v) for v in _split_unescaped(value, '|'))
+            elif op == 'null':
+                values = (_parse_flag(value), )
+            else:
+                values = (_unescape(value), )
+            if op == 'between' and len(values) != 2:
+                raise ValueError('between takes "low|high", got {!r}'.format(value))
+            clauses.append((key, op, values))
+        if clauses:
+            groups.append(tuple(clauses))
+    return tuple(groups)
+
+
+def _split_unescaped(text, sep, maxsplit=-1):
+    # type: (str, str, int) -> list
+    # the escapes stay put so the next split down still sees them, _unescape gets rid of them at the end
+    parts, start, i = [], 0, 0
+    while i < len(text):
+        if text[i] == '\\':
+            i += 2
+            continue
+        if text[i] == sep and len(parts) != maxsplit:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def _unescape(text):
+    # type: (str) -> str
+    chars, escaped = [], False
+    for char in text:
+        if char == '\\' and not escaped:
+            escaped = True
+            continue
+        chars.append(char)
+        escaped = False
+    return ''.join(chars)
+
+
+class _CursorJSONEncoder(json.JSONEncoder):
+    # keyset values have to survive the round trip with their type intact, or the comparison goes sideways
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return {'$datetime': obj.isoformat()}
+        if isinstance(obj, datetime.date):
+            return {'$date': obj.isoformat()}
+        if isinstance(obj, datetime.time):
+            return {'$time': obj.isoformat()}
+        if isinstance(obj, decimal.Decimal):
+            return {'$decimal': str(obj)}
+        if isinstance(obj, (bytes, bytearray)):  # mssql rowversions mostly
+            return {'$bytes': base64.b64encode(obj).decode('ascii')}
+        return json.JSONEncoder.default(self, obj)
+
+
+def _cursor_object_hook(dick):
+    if len(dick) == 1:
+        key, value = next(iter(dick.items()))
+        if key == '$datetime':
+            return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+        if key == '$date':
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        if key == '$time':
+            return datetime.datetime.strptime(value, '%H:%M:%S.%f' if '.' in value else '%H:%M:%S').time()
+        if key == '$decimal':
+            return decimal.Decimal(value)
+        if key == '$bytes':
+            return base64.b64decode(value.encode('ascii'))
+    return dick
+
+
+def _encode_token(payload):
+    # type: (dict) -> str
+    payload = json.dumps(payload, cls=_CursorJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_token(token):
+    # type: (str) -> dict
+    padded = token + '=' * (-len(token) % 4)
+    payload = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+    return json.loads(payload, object_hook=_cursor_object_hook)
+
+
+def encode_cursor(keys, order, direction, values):
+    # type: (list, str, str, list) -> str
+    return _encode_token(dict(k=keys, o=order, d=direction, v=values))
+
+
+def decode_cursor(token, keys, order):
+    # type: (str, list, str) -> tuple
+    try:
+        payload = _decode_token(token)
+        direction, values = payload['d'], payload['v']
+    except Exception:
+        raise ValueError('cursor {!r} is not a cursor this api handed out!'.format(token))
+    if payload['k'] != keys or payload['o'] != order or direction not in ['next', 'prev'] or len(values) != len(keys):
+        raise ValueError(
+            'cursor was made for order by {} {}, not {} {}!'.format(payload['k'], payload['o'], keys, order)
+        )
+    return direction, values
+
+
+def keyset_keys(resource, q, column_map, primary_key_map):
+    # type: (str, QueryParams, OrderedDict, OrderedDict) -> list
+    # the order_key alone isn't unique, so the primary key breaks the ties and makes the ordering total
+    if not primary_key_map:
+        return []
+    keys = [] if q.order_key is None else [q.order_key]
+    for key in primary_key_map:
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def _keyset_after(column, value, descending):
+    # nulls sort first ascending on mssql and sqlite, so "after null" is "not null",
+    # and nothing comes after null descending
+    if value is None:
+        return false() if descending else column.isnot(None)
+    if descending:
+        return or_(column < value, column.is_(None)) if column.nullable else column < value
+    return column > value
+
+
+def keyset_criterion(columns, values, descending):
+    # (a, b) > (x, y) spelled out as a > x or (a = x and b > y), mssql doesn't do row value comparisons.
+    # the leading column still gets an index seek, so every page costs the same no matter how deep it is.
+    # the values go in through keyset_params, only which of them are null changes the statement
+    binds = [
+        None if v is None else bindparam('_k{}'.format(i), type_=c.type)
+        for i, (c, v) in enumerate(zip(columns, values))
+    ]
+    clauses = []
+    for i, (column, bind) in enumerate(zip(columns, binds)):
+        prefix = [c.is_(None) if b is None else c == b for c, b in zip(columns[:i], binds[:i])]
+        clauses.append(and_(*(prefix + [_keyset_after(column, bind, descending)])))
+    return or_(*clauses)
+
+
+def keyset_params(values):
+    # type: (list) -> dict
+    return dict(('_k{}'.format(i), v) for i, v in enumerate(values) if v is not None)
+
+
+def filter_column(descriptor, key):
+    # type: (TableDescriptor, str) -> Column
+    if key not in descriptor.column_map:
+        raise RuntimeError(
+            '{!r} is not a real column for {!r}! these are: {}'.format(
+                key, descriptor.name, list(descriptor.column_map.keys())
+            )
+        )
+    return descriptor.table.c[descriptor.column_map[key]]
+
+
+def _predicates(q):
+    # every filter clause in the order build_criteria and criteria_params both number them
+    for groups in q.filters:
+        for clauses in groups:
+            for clause in clauses:
+                yield clause
+
+
+def _filter_expression(column, op, name, values):
+    if op == 'null':
+        return column.is_(None) if values[0] else column.isnot(None)
+    if op in ['in', 'nin']:
+        bind = bindparam(name, expanding=True, type_=column.type)  # any number of values, still the one statement
+        return column.in_(bind) if op == 'in' else column.notin_(bind)
+    if op == 'between':
+        return column.between(bindparam(name + '_0', type_=column.type), bindparam(name + '_1', type_=column.type))
+    if op in LIKE_OPS:
+        bind = bindparam(name, type_=String())
+        if op == 'prefix':  # the one that can still seek an index, criteria_params escapes the value
+            return column.like(bind, escape='\\')
+        if op == 'ilike' and ENGINE.dialect.name not in ['sqlite', 'mssql']:
+            return column.ilike(bind)
+        # sqlite's LIKE and mssql's usual *_CI_* collations already ignore case, and lower()ing the column
+        # would cost them any index on it
+        return column.like(bind)
+    bind = bindparam(name, type_=column.type)
+    if op == 'eq':
+        return column == bind
+    if op == 'ne':
+        return column != bind
+    if op == 'gt':
+        return column > bind
+    if op == 'ge':
+        return column >= bind
+    if op == 'lt':
+        return column < bind
+    return column <= bind
+
+
+def build_criteria(descriptor, q):
+    # type: (TableDescriptor, QueryParams) -> list
+    # bound parameters all the way down, the values come from criteria_params, so the same shape of query
+    # is the same statement no matter what it's looking for
+    resource, column_map, primary_key_map = descriptor.name, descriptor.column_map, descriptor.primary_key_map
+    criteria = []
+    if q.offset is not None:
+        if 'id' not in primary_key_map:
+            raise RuntimeError('{!r} is gonna need something custom to deal with offset.'.format(resource))
+        id_column = descriptor.table.c[primary_key_map['id']]
+        criteria.append(id_column >= bindparam('_offset', type_=id_column.type))
+
+    if q.search is not None:
+        resolve_search(descriptor, q)
+        if q.search_indexed:
+            primary_key = descriptor.primary_key[0]
+            criteria.append(primary_key.in_(bindparam('_search', expanding=True, type_=primary_key.type)))
+        else:
+            criteria.append(filter_column(descriptor, q.search_key).like(bindparam('_search', type_=String())))
+
+    predicates = enumerate(_predicates(q))
+    for groups in q.filters:
+        ors = []
+        for clauses in groups:
+            ands = []
+            for _ in clauses:
+                n, (key, op, values) = next(predicates)
+                ands.append(_filter_expression(filter_column(descriptor, key), op, '_f{}'.format(n), values))
+            ors.append(and_(*ands))
+        criteria.append(or_(*ors))
+
+    if q.order is not None:
+        if q.order_key not in column_map:
+            raise RuntimeError(
+                '{!r} is not a real column for {!r}! these are: {}'.format(
+                    q.order_key, resource, list(column_map.keys())
+                )
+            )
+    return criteria
+
+
+def criteria_params(descriptor, q):
+    # type: (TableDescriptor, QueryParams) -> dict
+    params = {}
+    if q.offset is not None:
+        params['_offset'] = q.offset
+    if q.search is not None:
+        resolve_search(descriptor, q)
+        params['_search'] = q.search_keys if q.search_indexed else q.search
+    for n, (key, op, values) in enumerate(_predicates(q)):
+        column = filter_column(descriptor, key)
+        name = '_f{}'.format(n)
+        if op == 'null':
+            continue
+        elif op == 'prefix':
+            params[name] = values[0].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        elif op in LIKE_OPS:
+            params[name] = values[0]
+        elif op in ['in', 'nin']:
+            params[name] = [coerce_value(column, v) for v in values]
+        elif op == 'between':
+            params[name + '_0'], params[name + '_1'] = [coerce_value(column, v) for v in values]
+        else:
+            params[name] = coerce_value(column, values[0])
+    return params
+
+
+def resolve_search(descriptor, q):
+    # type: (TableDescriptor, QueryParams) -> None
+    # a search over an indexed column turns into the primary keys the index matched, once per request.
+    # where_shape goes by what this decided, so criteria_params or build_criteria have to come first
+    if q.search is None or q.search_indexed is not None:
+        return
+    q.search_indexed = False
+    index = SEARCH_INDEXES.get(descriptor.name.lower(), {}).get(q.search_key)
+    if index is not None:
+        with span('search'):
+            q.search_keys = index.lookup(q.search)
+        q.search_indexed = q.search_keys is not None
+
+
+def where_shape(q):
+    # type: (QueryParams) -> tuple
+    # everything about the WHERE but the values, which is what the statement cache goes by
+    filters = tuple(
+        tuple(
+            tuple((key, op, values[0] if op == 'null' else None) for key, op, values in clauses)
+            for clauses in groups
+        ) for groups in q.filters
+    )
+    return (q.offset is not None, q.search_key if q.search is not None else None, q.search_indexed, filters)
+
+
+def coerce_value(column, value):
+    # type: (Column, str) -> object
+    # query strings are all text, and some bind processors won't take text, sqlite's DateTime for one
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    try:
+        if issubclass(python_type, bool):
+            if value.lower() in ['1', 'true', 'yes']:
+                return True
+            if value.lower() in ['0', 'false', 'no']:
+                return False
+            raise ValueError(value)
+        if issubclass(python_type, datetime.datetime):
+            return _strptime(value, DATETIME_FORMATS)
+        if issubclass(python_type, datetime.date):
+            return _strptime(value, DATETIME_FORMATS).date()
+        if issubclass(python_type, datetime.time):
+            return _strptime(value, TIME_FORMATS).time()
+        if issubclass(python_type, (int, float, decimal.Decimal)):
+            return python_type(value)
+    except (ValueError, decimal.InvalidOperation):
+        raise ValueError('{!r} is no good for {!r}, it takes a {}'.format(value, column.name, python_type.__name__))
+    return value
+
+
+def _strptime(value, formats):
+    for fmt in formats:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
+def bulk_criteria(descriptor, q):
+    # type: (TableDescriptor, QueryParams) -> list
+    # same filters as a GET, minus the paging which an UPDATE or DELETE can't honor anyway
+    if q.limit is not None or q.cursor is not None:
+        raise RuntimeError('limit and cursor make no sense for a {} over {!r}.'.format(request.method, descriptor.name))
+    criteria = build_criteria(descriptor, q)
+    if not criteria and not q.all_rows:
+        raise RuntimeError(
+            'no filters means every row in {!r}, say all=1 if thats really what you want.'.format(descriptor.name)
+        )
+    return criteria
+
+
+def total_count(session, descriptor, q, params):
+    # type: (object, TableDescriptor, QueryParams, dict) -> int
+    shape = ('_count', where_shape(q))
+    statement = descriptor.statements.get(shape)
+    if statement is None:
+        statement = select([func.count()]).select_from(descriptor.table)
+        for criterion in build_criteria(descriptor, q):
+            statement = statement.where(criterion)
+        descriptor.cache_statement(shape, statement)
+    return execute_cached(session, statement, params).scalar()
+
+
+def aggregate_statement(descriptor, q):
+    # type: (TableDescriptor, QueryParams) -> Select
+    group_columns = [filter_column(descriptor, key) for key in q.group_by]
+    columns = [c.label(key) for c, key in zip(group_columns, q.group_by)]
+    for name, key in q.aggregates or [('count', '*')]:
+        if key == '*':
+            if name != 'count':
+                raise ValueError('only count takes *, {} needs a column'.format(name))
+            columns.append(func.count().label('count'))
+        else:
+            columns.append(getattr(func, name)(filter_column(descriptor, key)).label('{}_{}'.format(name, key)))
+    statement = select(columns).select_from(descriptor.table)
+    for criterion in build_criteria(descriptor, q):
+        statement = statement.where(criterion)
+    if group_columns:
+        statement = statement.group_by(*group_columns).order_by(*group_columns)
+    if q.limit is not None:
+        statement = statement.limit(q.limit)
+    return statement
+
+
+def count_where(session, descriptor, criteria, params):
+    # type: (object, TableDescriptor, list, dict) -> int
+    statement = select([func.count()]).select_from(descriptor.table)
+    for criterion in criteria:
+        statement = statement.where(criterion)
+    return session.execute(statement, params).scalar()
+
+
+def sanitize_body(descriptor, body):
+    # type: (TableDescriptor, dict) -> dict
+    if not isinstance(body, dict):
+        raise ValueError('expected a json object, got {!r}'.format(body))
+    sanitized = {}
+    for k, v in body.items():
+        if k not in descriptor.column_map:
+            raise RuntimeError(
+                '{!r} is not a real column for {!r}! these are: {}'.format(
+                    k, descriptor.name, list(descriptor.column_map.keys())
+                )
+            )
+        sanitized[descriptor.column_map[k]] = v
+    return sanitized
+
+
+def cursor_url(cursor):
+    args = request.args.to_dict(flat=False)
+    args['cursor'] = [cursor]
+    return '{}?{}'.format(request.base_url, urlencode(args, doseq=True))
+
+
+class TableDescriptor(object):
+    # everything a request needs to know about a table, worked out once at reflection time instead of per request
+    __slots__ = (
+        'name', 'TABLE', 'table', 'introspection', 'columns', 'primary_key', 'column_map', 'primary_key_map', 'keys',
+        'getter', 'serializers', 'everything', 'projections', 'statements'
+    )
+
+    def __init__(self, name, TABLE):
+        self.name = name
+        self.TABLE = TABLE
+        self.introspection = inspect(TABLE)
+        self.table = self.introspection.local_table
+        self.columns = tuple(self.introspection.columns)
+        self.primary_key = tuple(self.introspection.primary_key)
+        self.column_map = OrderedDict((c.name.lower(), c.name) for c in self.columns)
+        self.primary_key_map = OrderedDict((c.name.lower(), c.name) for c in self.primary_key)
+        self.keys = tuple(self.column_map)
+        attributes = [self.introspection.get_property_by_column(c).key for c in self.columns]
+        if len(attributes) == 1:  # attrgetter hands back a bare value instead of a tuple for just one
+            self.getter = lambda obj, _get=attrgetter(attributes[0]): (_get(obj), )
+        else:
+            self.getter = attrgetter(*attributes)
+        self.serializers = tuple(serializer_for(c.type) for c in self.columns)
+        self.everything = Projection(self, self.keys)
+        self.projections = {}
+        self.statements = {}  # shape of a query -> the select for it, see generic_endpoint
+
+    def project(self, fields=None):
+        # type: (list) -> Projection
+        if fields is None:
+            return self.everything
+        key = tuple(fields)
+        projection = self.projections.get(key)
+        if projection is None:
+            for field in fields:
+                if field not in self.column_map:
+                    raise RuntimeError(
+                        '{!r} is not a real column for {!r}! these are: {}'.format(
+                            field, self.name, list(self.column_map.keys())
+                        )
+                    )
+            projection = Projection(self, fields)
+            if len(self.projections) < PROJECTION_CACHE_SIZE:
+                self.projections[key] = projection
+        return projection
+
+    def cache_statement(self, shape, statement):
+        # type: (tuple, Select) -> None
+        if len(self.statements) < STATEMENT_CACHE_SIZE:
+            self.statements[shape] = statement
+
+    def serialize(self, values):
+        # type: (tuple) -> dict
+        return self.everything.serialize(values)
+
+    def row_dict(self, orm_object):
+        # type: (object) -> dict
+        return self.serialize(self.getter(orm_object))
+
+
+class Projection(object):
+    # the columns a GET actually selects, and how to turn the tuples that come back into rows
+    __slots__ = ('keys', 'columns', 'serializers', 'conversions')
+
+    def __init__(self, descriptor, keys):
+        positions = [descriptor.keys.index(k) for k in keys]
+        self.keys = tuple(keys)
+        self.columns = tuple(descriptor.columns[i] for i in positions)
+        self.serializers = tuple(descriptor.serializers[i] for i in positions)
+        # only the columns json can't take as is get touched per row, the rest go straight to the encoder
+        self.conversions = tuple((i, f) for i, f in enumerate(self.serializers) if f is not None)
+
+    def serialize(self, values):
+        # type: (tuple) -> dict
+        return self.dicts([values])[0]
+
+    def dicts(self, rows):
+        # type: (list) -> list
+        # zip stops at the keys, so anything selected past them (like cursor keys) gets left out
+        keys, conversions = self.keys, self.conversions
+        if not conversions:
+            return [_row_dict(zip(keys, row)) for row in rows]
+        dicts = []
+        for row in rows:
+            values = list(row)
+            for i, f in conversions:
+                v = values[i]
+                if v is not None:
+                    values[i] = f(v)
+            dicts.append(_row_dict(zip(keys, values)))
+        return dicts
+
+    def dumps(self, rows):
+        # type: (list) -> bytes
+        return dumps(self.dicts(rows))
+
+    def dumps_lines(self, rows):
+        # type: (list) -> bytes
+        return b''.join([dumps(dick) + b'\n' for dick in self.dicts(rows)])
+
+
+def _isoformat(obj):
+    return obj.isoformat()
+
+
+def _base64(obj):
+    return base64.b64encode(obj).decode('ascii')
+
+
+def serializer_for(column_type):
+    # picked once per column so the json encoder never has to guess what it's looking at
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return None
+    if issubclass(python_type, datetime.datetime):
+        return str  # the microsecond format is what I want
+    if issubclass(python_type, (datetime.date, datetime.time)):
+        return _isoformat
+    if issubclass(python_type, (decimal.Decimal, uuid.UUID)):
+        return str  # floats would quietly eat the precision
+    if issubclass(python_type, (bytes, bytearray)) and python_type is not str:
+        return _base64
+    return None
+
+
+def build_registry(base):
+    registry = OrderedDict()
+    for name in sorted(base.classes.keys()):
+        registry[name.lower()] = TableDescriptor(name, getattr(base.classes, name))
+    return _frozen(registry)
+
+
+def refresh_registry():
+    # re-reflect and swap everything at once, requests already in flight finish on the old registry
+    global BASE, METADATA, REGISTRY, TABLE_NAMES
+    with REGISTRY_LOCK:
+        base, metadata, registry, table_names = reflect_schema(METADATA.schema, REFLECT_MODE)
+        BASE, METADATA, REGISTRY, TABLE_NAMES = base, metadata, registry, table_names
+        RESPONSE_CACHE.clear()  # a different schema makes every cached document suspect
+        if PRIVILEGES is not None:
+            PRIVILEGES.expires = 0.0  # new tables come with grants of their own
+        for indexes in SEARCH_INDEXES.values():
+            for index in indexes.values():
+                index.stale = True
+    app.logger.info('registry refreshed, {} tables'.format(len(known_tables())))
+    return registry
+
+
+def lookup_table(resource):
+    # type: (str) -> TableDescriptor
+    descriptor = REGISTRY.get(resource.lower())
+    if descriptor is None:
+        if resource.lower() in TABLE_NAMES:
+            return reflect_tables([TABLE_NAMES[resource.lower()]])[0]
+        raise RuntimeError('{!r} not in {}'.format(resource, known_tables()))
+    return descriptor
+
+
+def known_tables():
+    # type: () -> list
+    names = {d.name.lower(): d.name for d in REGISTRY.values()}
+    names.update(TABLE_NAMES)
+    return sorted(names.values())
+
+
 def inspect_table(table):
-    table_map = {t.lower(): t for t in dir(BASE.classes) if '__' not in t}
+    descriptor = lookup_table(table)
+    return descriptor.TABLE, descriptor.introspection, descriptor.column_map, descriptor.primary_key_map
+
+
+def stream_rows(session, statement, params, projection, reverse=False):
+    # server side cursor, so only a batch worth of rows is ever alive no matter how big the table is
+    try:
+        result_proxy = execute_cached(session, statement, params)  # stream_results is baked into the statement
+        if reverse:  # only prev pages, which are as big as their limit
+            batches = [list(reversed(result_proxy.fetchall()))]
+        else:
+            batches = iter(lambda: result_proxy.fetchmany(STREAM_BATCH_SIZE), [])
+        for batch in batches:
+            yield projection.dumps_lines(batch)
+    except Exception as e:
+        # the status line is long gone, so the best that can be done is a last line saying why it stopped
+        app.logger.exception('stream died')
+        yield dumps(dict(error=str(e), traceback=traceback.format_exc())) + b'\n'
+    finally:
+        session.close()
+
+
+class _Chunks(object):
+    # a file for pyarrow to write into, that hands over whatever it got so far when asked
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))  # pyarrow reuses its buffers
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        # type: () -> bytes
+        chunks, self.chunks = self.chunks, []
+        return b''.join(chunks)
+
+
+def arrow_type(column_type):
+    # type: (object) -> tuple
+    # (arrow type, what each value goes through first), picked once per column like serializer_for,
+    # anything arrow has no better type for goes over as text
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return pyarrow.string(), text_type
+    if issubclass(python_type, bool):
+        return pyarrow.bool_(), None
+    if issubclass(python_type, int):
+        return pyarrow.int64(), None
+    if issubclass(python_type, float):
+        return pyarrow.float64(), None
+    if issubclass(python_type, decimal.Decimal):
+        precision, scale = getattr(column_type, 'precision', None), getattr(column_type, 'scale', None)
+        if precision and precision <= 38:
+            return pyarrow.decimal128(precision, scale or 0), None
+        return pyarrow.string(), text_type
+    if issubclass(python_type, datetime.datetime):
+        return pyarrow.timestamp('us'), None
+    if issubclass(python_type, datetime.date):
+        return pyarrow.date32(), None
+    if issubclass(python_type, datetime.time):
+        return pyarrow.time64('us'), None
+    if issubclass(python_type, (bytes, bytearray)) and python_type is not str:
+        return pyarrow.binary(), None
+    if issubclass(python_type, string_types):
+        return pyarrow.string(), None
+    return pyarrow.string(), text_type
+
+
+def arrow_schema(projection, rows):
+    # type: (Projection, list) -> tuple
+    # strings that repeat a lot in the first batch get dictionary encoded, which is most of a status column's bytes
+    fields, converters = [], []
+    for i, (key, column) in enumerate(zip(projection.keys, projection.columns)):
+        value_type, converter = arrow_type(column.type)
+        if value_type == pyarrow.string() and rows:
+            distinct = len(set(row[i] for row in rows))
+            if distinct <= len(rows) // 2:
+                value_type = pyarrow.dictionary(pyarrow.int32(), value_type)
+        fields.append(pyarrow.field(key, value_type))
+        converters.append(converter)
+    return pyarrow.schema(fields), converters
+
+
+def arrow_batch(schema, converters, rows):
+    # type: (pyarrow.Schema, list, list) -> pyarrow.RecordBatch
+    arrays = []
+    for field, converter, values in zip(schema, converters, zip(*rows)):
+        if converter is not None:
+            values = [None if v is None else converter(v) for v in values]
+        if pyarrow.types.is_dictionary(field.type):
+            arrays.append(pyarrow.array(values, type=field.type.value_type).dictionary_encode())
+        else:
+            arrays.append(pyarrow.array(values, type=field.type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_rows(session, statement, params, projection, batch_size, compression=None):
+    # an arrow ipc stream, one record batch per fetchmany off a server side cursor
+    try:
+        result_proxy = execute_cached(session, statement, params)
+        batches = iter(lambda: result_proxy.fetchmany(batch_size), [])
+        first = next(batches, [])
+        schema, converters = arrow_schema(projection, first)
+        sink = _Chunks()
+        writer = pyarrow.ipc.new_stream(sink, schema, options=pyarrow.ipc.IpcWriteOptions(compression=compression))
+        yield sink.take()
+        for batch in itertools.chain([first] if first else [], batches):
+            writer.write_batch(arrow_batch(schema, converters, batch))
+            yield sink.take()
+        writer.close()
+        yield sink.take()
+    except Exception:
+        # no json line to explain it like stream_rows, but no end of stream marker either, so readers know
+        app.logger.exception('export died')
+    finally:
+        session.close()
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class NdjsonLine(object):
+    # a line of an NDJSON body, parsed by bulk_insert inside the batch it lands in, so a bad one fails that batch
+    # and shows up in the summary instead of blowing up halfway through, after the batches before it committed
+    __slots__ = ('number', 'text')
+
+    def __init__(self, number, text):
+        self.number = number
+        self.text = text
+
+    def parse(self):
+        try:
+            return json.loads(self.text.strip())
+        except ValueError as e:
+            raise ValueError('line {} is no good json: {}'.format(self.number, e))
+
+
+def ndjson_lines(stream):
+    # type: (iter) -> iter
+    return (NdjsonLine(number, line) for number, line in enumerate(stream, 1) if line.strip())
+
+
+def primary_key_criterion(columns, values_list):
+    # type: (list, list) -> object
+    # mssql doesn't do (a, b) in ((1, 2), ...), so composite keys get spelled out
+    if len(columns) == 1:
+        return columns[0].in_([values[0] for values in values_list])
+    return or_(*[and_(*[c == v for c, v in zip(columns, values)]) for values in values_list])
+
+
+def existing_primary_keys(session, descriptor, values_list):
+    # type: (object, TableDescriptor, list) -> set
+    columns = list(descriptor.primary_key)
+    existing = set()
+    # mssql tops out at 2100 parameters a statement
+    for chunk in _batched(values_list, max(1, (MSSQL_MAX_PARAMETERS - 100) // len(columns))):
+        statement = select(columns).where(primary_key_criterion(columns, chunk))
+        existing.update(tuple(row) for row in session.execute(statement))
+    return existing
+
+
+def bulk_insert(session, descriptor, body, batch_size, on_conflict):
+    # type: (object, TableDescriptor, iter, int, str) -> OrderedDict
+    # one executemany per batch (and per key set within it) instead of one commit per row,
+    # each batch commits or rolls back on its own so one bad row doesn't take the whole load down with it
+    table, column_map = descriptor.table, descriptor.column_map
+    pk_names = [c.name for c in descriptor.primary_key]
+    if on_conflict == 'update' and not pk_names:
+        raise RuntimeError('{!r} has no primary key to upsert by.'.format(descriptor.name))
+    key_sets = {}  # validated once per distinct set of keys, not once per row
+    summary = OrderedDict([('inserted', 0), ('updated', 0), ('failed', 0), ('batches', [])])
+    for i, batch in enumerate(_batched(body, batch_size)):
+        report = OrderedDict([('batch', i), ('rows', len(batch)), ('inserted', 0), ('updated', 0), ('error', None)])
+        try:
+            groups = OrderedDict()
+            for row in batch:
+                if isinstance(row, NdjsonLine):
+                    row = row.parse()
+                if not isinstance(row, dict):
+                    raise ValueError('rows have to be json objects, got {!r}'.format(row))
+                keys = frozenset(row)
+                names = key_sets.get(keys)
+                if names is None:
+                    for k in keys:
+                        if k not in column_map:
+                            raise RuntimeError(
+                                '{!r} is not a real column for {!r}! these are: {}'.format(
+                                    k, descriptor.name, list(column_map.keys())
+                                )
+                            )
+                    names = key_sets[keys] = {k: column_map[k] for k in keys}
+                groups.setdefault(keys, []).append({names[k]: v for k, v in row.items()})
+
+            inserts, updates = [], []
+            if on_conflict == 'update':
+                for sanitized in (r for group in groups.values() for r in group):
+                    if any(name not in sanitized for name in pk_names):
+                        raise ValueError('upserting needs the whole primary key {} in every row'.format(pk_names))
+                    for name in pk_names:
+                        # {"id": "5"} is row 5 as far as the database goes, it has to be for the lookup too
+                        if isinstance(sanitized[name], string_types):
+                            sanitized[name] = coerce_value(table.c[name], sanitized[name])
+                existing = existing_primary_keys(
+                    session, descriptor, [tuple(r[n] for n in pk_names) for group in groups.values() for r in group]
+                )
+                for group in groups.values():
+                    for sanitized in group:
+                        pk = tuple(sanitized[n] for n in pk_names)
+                        (updates if pk in existing else inserts).append(sanitized)
+                        existing.add(pk)  # the same key twice in one load, the second one updates the first
+                groups = OrderedDict()
+                for sanitized in inserts:
+                    groups.setdefault(frozenset(sanitized), []).append(sanitized)
+
+            for group in groups.values():
+                session.execute(table.insert(), group)  # a list of params is an executemany
+                report['inserted'] += len(group)
+            update_groups = OrderedDict()
+            for sanitized in updates:
+                update_groups.setdefault(frozenset(sanitized), []).append(sanitized)
+            for names, group in update_groups.items():
+                statement = table.update()
+                for name in pk_names:
+                    statement = statement.where(table.c[name] == bindparam('_pk_{}'.format(name)))
+                statement = statement.values({name: bindparam(name) for name in names if name not in pk_names})
+                params = []
+                for sanitized in group:
+                    param = dict(sanitized)
+                    for name in pk_names:
+                        param['_pk_{}'.format(name)] = param.pop(name)
+                    params.append(param)
+                if len(names) > len(pk_names):  # nothing but the key means nothing to update
+                    session.execute(statement, params)
+                report['updated'] += len(group)
+            session.commit()
+            index_rows(descriptor, [r for group in groups.values() for r in group] + updates)
+        except Exception as e:
+            session.rollback()
+            app.logger.exception('bulk insert batch {} into {!r} failed'.format(i, descriptor.name))
+            report['inserted'] = report['updated'] = 0
+            report['error'] = str(e)
+            summary['failed'] += len(batch)
+        summary['inserted'] += report['inserted']
+        summary['updated'] += report['updated']
+        summary['batches'].append(report)
+    return summary
+
+
+def trigrams(text):
+    # type: (str) -> set
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def like_regex(pattern):
+    # type: (str) -> re.Pattern
+    # what LIKE does with % and _, for checking the candidates an index comes up with
+    return re.compile(
+        '^{}$'.format(''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern)), re.S
+    )
+
+
+class SearchIndex(object):
+    # a trigram index over one text column, kept in process, so search= looks up the primary keys whose text
+    # matches instead of running a '%term%' LIKE over the whole table, and one keyed SELECT fetches the rows.
+    # built on first use, kept up to date by the writes that go through generic_endpoint, and rebuilt from
+    # scratch whenever it went stale, which is anything it couldn't follow, or POST /api/v1/_reindex
+    def __init__(self, resource, key):
+        self.resource = resource
+        self.key = key
+        self.column = None  # real column names, once built
+        self.primary_key = None
+        self.lock = threading.Lock()
+        self.texts = {}  # primary key -> lowercase text
+        self.postings = {}  # trigram -> set of primary keys
+        self.stale = True
+        self.builds = 0
+        self.build_seconds = None
+        self.lookups = 0
+        self.fallbacks = 0
+
+    def rebuild(self):
+        # type: () -> OrderedDict
+        with self.lock:
+            self._build()
+        return self.snapshot()
+
+    def _build(self):
+        descriptor = lookup_table(self.resource)
+        if len(descriptor.primary_key) != 1:
+            raise RuntimeError(
+                '{!r} needs a single column primary key to search index {!r}.'.format(descriptor.name, self.key)
+            )
+        primary_key, column = descriptor.primary_key[0], filter_column(descriptor, self.key)
+        started = time.time()
+        self.texts, self.postings = {}, {}
+        # the primary, the replicas might not have caught up with a write the index is about to hear about
+        connection = ENGINE.connect()
+        try:
+            statement = select([primary_key, column]).where(column.isnot(None))
+            result_proxy = connection.execution_options(stream_results=True).execute(statement)
+            for batch in iter(lambda: result_proxy.fetchmany(STREAM_BATCH_SIZE), []):
+                for key, value in batch:
+                    self._add(key, value)
+        finally:
+            connection.close()
+        self.column, self.primary_key = column.name, primary_key.name
+        self.stale = False
+        self.builds += 1
+        self.build_seconds = time.time() - started
+        app.logger.info(
+            'search indexed {} rows of {}.{} in {:.3f}s'.format(
+                len(self.texts), descriptor.name, column.name, self.build_seconds
+            )
+        )
+
+    def _add(self, key, text):
+        text = text_type(text).lower()
+        self.texts[key] = text
+        for gram in trigrams(text):
+            self.postings.setdefault(gram, set()).add(key)
+
+    def _drop(self, key):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for gram in trigrams(text):
+            keys = self.postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+
+    def lookup(self, pattern):
+        # type: (str) -> list
+        # the primary keys whose text is LIKE pattern, None when there are too many to be worth binding
+        match = like_regex(pattern).match
+        grams = set()
+        for fragment in re.split('[%_]', pattern):
+            grams.update(trigrams(fragment))
+        with self.lock:
+            if self.stale:
+                self._build()
+            self.lookups += 1
+            if not grams:
+                # nothing three characters long to narrow it down with, a LIKE with a limit stops sooner
+                self.fallbacks += 1
+                return None
+            # every trigram of every literal piece has to be in there, rarest first keeps the sets small
+            postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            keys = []
+            for key in candidates:
+                if match(self.texts[key]):
+                    keys.append(key)
+                    if len(keys) > SEARCH_MAX_KEYS:
+                        self.fallbacks += 1
+                        return None
+        return keys
+
+    def update(self, rows):
+        # type: (list) -> None
+        # rows as written, {real column name: value}, a row without its primary key can't be placed
+        with self.lock:
+            if self.stale:
+                return  # whenever it gets built it'll read these anyway
+            for row in rows:
+                if self.primary_key not in row:
+                    self.stale = True
+                    return
+                if self.column in row:
+                    self._drop(row[self.primary_key])
+                    if row[self.column] is not None:
+                        self._add(row[self.primary_key], row[self.column])
+
+    def remove(self, keys):
+        # type: (list) -> None
+        with self.lock:
+            if not self.stale:
+                for key in keys:
+                    self._drop(key)
+
+    def snapshot(self):
+        # type: () -> OrderedDict
+        return OrderedDict([
+            ('rows', len(self.texts)),
+            ('trigrams', len(self.postings)),
+            ('stale', self.stale),
+            ('builds', self.builds),
+            ('build_seconds', self.build_seconds),
+            ('lookups', self.lookups),
+            ('fallbacks', self.fallbacks),
+        ])
+
+
+def parse_search_indexes(text):
+    # type: (str) -> dict
+    # "people.name,people.title" -> {'people': {'name': SearchIndex, 'title': SearchIndex}}
+    indexes = OrderedDict()
+    for spec in text.split(','):
+        resource, dot, key = spec.strip().lower().partition('.')
+        if not (resource and dot and key):
+            raise ValueError('search indexes look like <table>.<column>, got {!r}'.format(spec))
+        indexes.setdefault(resource, OrderedDict())[key] = SearchIndex(resource, key)
+    return indexes
+
+
+def search_indexes(resource):
+    # type: (str) -> list
+    return list(SEARCH_INDEXES.get(resource.lower(), {}).values())
+
+
+def index_rows(descriptor, rows):
+    # type: (TableDescriptor, list) -> None
+    for index in search_indexes(descriptor.name):
+        index.update(rows)
+
+
+def unindex_keys(descriptor, keys):
+    # type: (TableDescriptor, list) -> None
+    for index in search_indexes(descriptor.name):
+        index.remove(keys)
+
+
+def stale_indexes(resource):
+    # type: (str) -> None
+    for index in search_indexes(resource):
+        index.stale = True
+
+
+def touched_keys(session, descriptor, criteria, params, columns=None):
+    # type: (object, TableDescriptor, list, dict, dict) -> list
+    # the primary keys an UPDATE (columns) or DELETE is about to hit, but only if a built search index or a change
+    # feed cares about them. composite keys come back as tuples
+    wanted = columns is None and descriptor.name.lower() in CHANGE_FEEDS and bool(descriptor.primary_key)
+    for index in search_indexes(descriptor.name):
+        if columns is not None and index.primary_key in columns:
+            index.stale = True  # rows changing their keys is more than it follows
+        elif not index.stale and (columns is None or index.column in columns):
+            wanted = True
+    if not wanted:
+        return None
+    statement = select(list(descriptor.primary_key))
+    for criterion in criteria:
+        statement = statement.where(criterion)
+    return [row[0] if len(row) == 1 else tuple(row) for row in session.execute(statement, params)]
+
+
+class ChangeFeed(object):
+    # what GET /api/v1/<resource>/_changes goes by: the column that says when a row last changed (a rowversion,
+    # a timestamp something keeps up, or a key that only goes up if rows never change), the deletes that went
+    # through this process, since a deleted row can't say so itself, and a condition writes wake long polls with
+    def __init__(self, resource, key):
+        self.resource = resource
+        self.key = key
+        self.condition = threading.Condition()
+        self.writes = 0  # so a long poll can tell whether anything happened while it wasn't looking
+        self.epoch = uuid.uuid4().hex  # the tombstones only mean something to tokens from this very process
+        self.tombstones = collections.deque()  # (sequence, primary key)
+        self.sequence = 0
+        self.forgotten = 0  # the newest sequence that fell off the end
+        # with --workers every delete takes its sequence off one counter they all share, so a worker can tell
+        # when deletes since a token went through somebody else, see serve
+        self.shared = None
+
+    def wrote(self):
+        with self.condition:
+            self.writes += 1
+            self.condition.notify_all()
+
+    def deleted(self, keys):
+        # type: (list) -> None
+        with self.condition:
+            for key in keys:
+                if self.shared is None:
+                    self.sequence += 1
+                else:
+                    with self.shared.get_lock():
+                        self.shared.value += 1
+                        self.sequence = self.shared.value
+                self.tombstones.append((self.sequence, key))
+            while len(self.tombstones) > CHANGES_TOMBSTONES:
+                self.forgotten = self.tombstones.popleft()[0]
+            self.writes += 1
+            self.condition.notify_all()
+
+    def latest(self):
+        # type: () -> int
+        return self.sequence if self.shared is None else self.shared.value
+
+    def deletes_since(self, epoch, sequence):
+        # type: (str, int) -> tuple
+        # (the keys deleted after sequence, the sequence now, whether that's really all of them)
+        with self.condition:
+            latest = self.latest()
+            complete = epoch == self.epoch and sequence >= self.forgotten
+            if not complete:
+                sequence = 0  # whatever there is then, deleting what's already gone won't hurt anybody
+            keys = []
+            for seq, key in reversed(self.tombstones):
+                if seq <= sequence:
+                    break
+                keys.append(key)
+            keys.reverse()
+            # every sequence in between that isn't one of ours is a delete another worker knows about
+            complete = complete and len(keys) == latest - sequence
+            return keys, latest, complete
+
+    def wait(self, writes, seconds):
+        # type: (int, float) -> None
+        with self.condition:
+            if self.writes == writes:
+                self.condition.wait(seconds)
+
+
+def parse_change_feeds(text):
+    # type: (str) -> dict
+    # "people.updated,orders.rowversion" -> {'people': ChangeFeed, 'orders': ChangeFeed}
+    feeds = OrderedDict()
+    for spec in text.split(','):
+        resource, dot, key = spec.strip().lower().partition('.')
+        if not (resource and dot and key):
+            raise ValueError('change feeds look like <table>.<column>, got {!r}'.format(spec))
+        if resource in feeds:
+            raise ValueError('{!r} can only have the one change feed'.format(resource))
+        feeds[resource] = ChangeFeed(resource, key)
+    return feeds
+
+
+def record_deletes(descriptor, keys):
+    # type: (TableDescriptor, list) -> None
+    # a _batch in a transaction holds onto them until it knows whether they happened
+    feed = CHANGE_FEEDS.get(descriptor.name.lower())
+    if feed is None or not keys:
+        return
+    pending = g.get('pending_deletes')
+    if pending is not None:
+        pending.append((feed, keys))
+    else:
+        feed.deleted(keys)
+
+
+def wake_pollers(resource):
+    # type: (str) -> None
+    feed = CHANGE_FEEDS.get(resource.lower())
+    if feed is not None:
+        feed.wrote()
+
+
+def encode_since(values, epoch, sequence):
+    # type: (list, str, int) -> str
+    return _encode_token(dict(v=values, e=epoch, s=sequence))
+
+
+def decode_since(token, width):
+    # type: (str, int) -> tuple
+    try:
+        payload = _decode_token(token)
+        values, epoch, sequence = payload['v'], payload['e'], int(payload['s'])
+    except Exception:
+        raise ValueError('since {!r} is not a token this api handed out!'.format(token))
+    if values is not None and len(values) != width:
+        raise ValueError('since {!r} was made for a different change column or primary key!'.format(token))
+    return values, epoch, sequence
+
+
+class CacheEntry(object):
+    __slots__ = ('body', 'mimetype', 'headers', 'etag', 'expires', 'size', 'variants', 'cached')
+
+    def __init__(self, body, mimetype, headers, expires):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.expires = expires
+        self.size = len(body) + 256  # give or take the bookkeeping
+        self.variants = {}  # content encoding -> the body compressed with it, made the first time it's asked for
+        self.cached = False
+
+
+class ResponseCache(object):
+    # lru with a ttl and a byte budget; the first element of every key is its tag (the lowercase table name, mostly),
+    # which is what invalidate() throws out and what the generation counter guards
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES, max_bytes=RESPONSE_CACHE_BYTES, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.generations = {}
+        self.invalidated = {}  # tag -> when it was last invalidated
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key):
+        # type: (tuple) -> CacheEntry
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires is not None and entry.expires < time.time():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def generation(self, tag):
+        # type: (str) -> int
+        # grab this before reading the database; if a write lands in between, put() knows not to keep the result
+        return self.generations.get(tag, 0)
+
+    def put(self, key, body, mimetype, headers, generation, ttl=-1):
+        # type: (tuple, bytes, str, dict, int, float) -> CacheEntry
+        ttl = self.ttl if ttl == -1 else ttl
+        entry = CacheEntry(body, mimetype, headers, None if ttl is None else time.time() + ttl)
+        if not self.enabled or ttl == 0 or entry.size > self.max_bytes // 8:
+            return entry  # still good for an etag, just not worth keeping
+        with self.lock:
+            if self.generations.get(key[0], 0) != generation:
+                return entry
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = entry
+            self.tags.setdefault(key[0], set()).add(key)
+            self.size += entry.size
+            entry.cached = True
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        return entry
+
+    def variant(self, entry, encoding):
+        # type: (CacheEntry, str) -> bytes
+        # compressed once per encoding and kept with the entry, so a hit is just handing over the bytes
+        body = entry.variants.get(encoding)
+        if body is not None:
+            return body
+        body = compress(entry.body, encoding, CACHED_COMPRESS_LEVELS if entry.cached else COMPRESS_LEVELS)
+        with self.lock:
+            if entry.cached and encoding not in entry.variants:
+                entry.variants[encoding] = body
+                entry.size += len(body)
+                self.size += len(body)
+                while self.size > self.max_bytes and self.entries:
+                    self._drop(next(iter(self.entries)))
+                    self.evictions += 1
+        return body
+
+    def invalidate(self, tag):
+        # type: (str) -> None
+        with self.lock:
+            self.generations[tag] = self.generations.get(tag, 0) + 1
+            self.invalidated[tag] = time.time()
+            for key in list(self.tags.get(tag, ())):
+                self._drop(key)
+            self.invalidations += 1
+
+    def invalidated_within(self, tag, seconds):
+        # type: (str, float) -> bool
+        return time.time() - self.invalidated.get(tag, 0.0) < seconds
+
+    def clear(self):
+        with self.lock:
+            for tag in set(self.tags) | set(self.generations):
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+            for entry in self.entries.values():
+                entry.cached = False
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+            self.invalidations += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        entry.cached = False
+        self.size -= entry.size
+        keys = self.tags.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.tags[key[0]]
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+def _write_slot(resource):
+    # type: (str) -> int
+    return zlib.crc32(resource.lower().encode('utf-8')) % WRITE_SLOTS
+
+
+def announce_write(resource):
+    # type: (str) -> None
+    # the other --workers drop what they had on the table at their next request, this one already has
+    if WRITES is None:
+        return
+    slot = _write_slot(resource)
+    with WRITES.get_lock():
+        if WRITES[slot] == _WRITES_SEEN[slot]:
+            _WRITES_SEEN[slot] += 1  # nobody else wrote to it in the meantime, so there's nothing to catch up on
+        WRITES[slot] += 1
+
+
+@app.before_request
+def catch_up_on_writes():
+    # whatever the other --workers wrote to since this one last looked goes out of its cache and search indexes
+    global _WRITES_SEEN
+    if WRITES is None:
+        return
+    writes = WRITES[:]
+    if writes == _WRITES_SEEN:
+        return
+    slots = set(i for i, (now, seen) in enumerate(zip(writes, _WRITES_SEEN)) if now != seen)
+    _WRITES_SEEN = writes
+    for name in set(REGISTRY) | set(TABLE_NAMES) | set(SEARCH_INDEXES):
+        if _write_slot(name) in slots:
+            RESPONSE_CACHE.invalidate(name)
+            stale_indexes(name)
+
+
+@app.after_request
+def closing_time(response):
+    # so keep-alive clients move on to a worker that's sticking around
+    if RETIRING:
+        response.headers['Connection'] = 'close'
+    return response
+
+
+def cached_response(entry):
+    # type: (CacheEntry) -> Response
+    encoding = accepted_encoding(entry.mimetype, len(entry.body))
+    if encoding is None:
+        response = Response(entry.body, mimetype=entry.mimetype, headers=entry.headers)
+        response.set_etag(entry.etag)
+    else:
+        with span('compress'):
+            body = RESPONSE_CACHE.variant(entry, encoding)
+        response = Response(body, mimetype=entry.mimetype, headers=entry.headers)
+        response.headers['Content-Encoding'] = encoding
+        response.set_etag('{}-{}'.format(entry.etag, encoding))  # a different representation, a different etag
+    if ENCODINGS and entry.mimetype in COMPRESS_MIMETYPES:
+        response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
+
+
+def accepted_encoding(mimetype, size):
+    # type: (str, int) -> str
+    # the first of ENCODINGS the client takes, ties going to the order they're in, None for as is
+    if not ENCODINGS or mimetype not in COMPRESS_MIMETYPES or size < COMPRESS_MIN_BYTES:
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def compress(body, encoding, levels=COMPRESS_LEVELS):
+    # type: (bytes, str, dict) -> bytes
+    compressor = StreamCompressor(encoding, levels)
+    return compressor.push(body, flush=False) + compressor.finish()
+
+
+class StreamCompressor(object):
+    # one interface over the three, push() hands back whatever can go out so far, so a stream gets compressed
+    # as it goes instead of being held back until the end
+    def __init__(self, encoding, levels=COMPRESS_LEVELS):
+        self.encoding = encoding
+        level = levels[encoding]
+        if encoding == 'zstd':
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == 'br':
+            self.compressor = brotli.Compressor(quality=level)
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16+ is the gzip wrapper
+
+    def push(self, data, flush=True):
+        # type: (bytes, bool) -> bytes
+        if self.encoding == 'br':
+            out = self.compressor.process(data)
+            return out + self.compressor.flush() if flush else out
+        out = self.compressor.compress(data)
+        if not flush:
+            return out
+        if self.encoding == 'zstd':
+            return out + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return out + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        # type: () -> bytes
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    # every chunk goes out as soon as it's compressed, a line of NDJSON or a long poll can't wait on the next one
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, text_type):
+                chunk = chunk.encode('utf-8')
+            out = compressor.push(chunk)
+            if out:
+                yield out
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()  # stream_with_context and stream_rows clean up in there
+
 
-    if not hasattr(BASE.classes, table_map[table.lower()]):
-        raise ValueError('provided table: "{}"; existing tables: {}'.format(table, dir(BASE.classes)))
+class Timings(object):
+    # one per sampled request, hangs off flask.g
+    __slots__ = ('started', 'phases', 'rows', 'total')
 
-    TABLE = getattr(BASE.classes, table_map[table.lower()])
-    introspection = inspect(TABLE)
-    column_map = OrderedDict()
-    for column in introspection.columns:
-        column_map[column.name.lower()] = column.name
+    def __init__(self):
+        self.started = default_timer()
+        self.phases = OrderedDict()
+        self.rows = 0
+        self.total = None
 
-    primary_key_map = OrderedDict()
-    for key in introspection.primary_key:
-        primary_key_map[key.name.lower()] = key.name
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self):
+        self.total = default_timer() - self.started
+
+    def server_timing(self):
+        # type: () -> str
+        phases = list(self.phases.items()) + [('total', self.total)]
+        return ', '.join('{};dur={:.3f}'.format(phase, seconds * 1000) for phase, seconds in phases)
+
+
+class _Span(object):
+    __slots__ = ('timings', 'phase', 'started')
+
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = default_timer()
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.phase, default_timer() - self.started)
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(phase):
+    # a no-op for whatever didn't get sampled, so the unsampled cost is one lookup on g
+    timings = g.get('timings')
+    return _NULL_SPAN if timings is None else _Span(timings, phase)
+
+
+def note_rows(count):
+    timings = g.get('timings')
+    if timings is not None:
+        timings.rows += count
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(STATS_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(STATS_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        # type: (float) -> float
+        # the usual bucket interpolation, so it's as good as the buckets are
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative, lower = 0, 0.0
+        for bound, count in zip(STATS_BUCKETS, self.counts):
+            if count and cumulative + count >= rank:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound if bound != float('inf') else lower
+        return lower
+
+
+class RequestStats(object):
+    # latency histograms per (resource, method, phase), rows and bytes per (resource, method)
+    def __init__(self, sample_rate=STATS_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.histograms = OrderedDict()
+        self.rows = OrderedDict()
+        self.bytes = OrderedDict()
+
+    def sampled(self):
+        return self.sample_rate >= 1 or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def record(self, resource, method, timings, response_bytes):
+        with self.lock:
+            for phase, seconds in list(timings.phases.items()) + [('total', timings.total)]:
+                key = (resource, method, phase)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.observe(seconds)
+            self.rows[(resource, method)] = self.rows.get((resource, method), 0) + timings.rows
+            if response_bytes is not None:
+                self.bytes[(resource, method)] = self.bytes.get((resource, method), 0) + response_bytes
+
+    def prometheus(self):
+        # type: () -> str
+        # https://prometheus.io/docs/instrumenting/exposition_formats/
+        ns = STATS_NAMESPACE
+        lines = [
+            '# HELP {}_request_seconds time spent per phase of a request, only the sampled ones'.format(ns),
+            '# TYPE {}_request_seconds histogram'.format(ns),
+        ]
+        with self.lock:
+            quantiles = []
+            for (resource, method, phase), histogram in self.histograms.items():
+                labels = 'resource="{}",method="{}",phase="{}"'.format(resource, method, phase)
+                cumulative = 0
+                for bound, count in zip(STATS_BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_request_seconds_bucket{{{},le="{}"}} {}'.format(ns, labels, le, cumulative))
+                lines.append('{}_request_seconds_sum{{{}}} {!r}'.format(ns, labels, histogram.sum))
+                lines.append('{}_request_seconds_count{{{}}} {}'.format(ns, labels, histogram.count))
+                for q in STATS_QUANTILES:
+                    quantiles.append(
+                        '{}_request_seconds_estimate{{{},quantile="{}"}} {!r}'.format(
+                            ns, labels, q, histogram.quantile(q)
+                        )
+                    )
+            lines.append('# HELP {}_request_seconds_estimate quantiles interpolated from the histogram'.format(ns))
+            lines.append('# TYPE {}_request_seconds_estimate gauge'.format(ns))
+            lines.extend(quantiles)
+            for name, counter in [('rows', self.rows), ('response_bytes', self.bytes)]:
+                lines.append('# TYPE {}_{}_total counter'.format(ns, name))
+                for (resource, method), value in counter.items():
+                    lines.append(
+                        '{}_{}_total{{resource="{}",method="{}"}} {}'.format(ns, name, resource, method, value)
+                    )
 
-    return TABLE, introspection, column_map, primary_key_map
+        lines.append('# TYPE {}_pool gauge'.format(ns))
+        pools = [('primary', ENGINE.pool.stats.snapshot(ENGINE.pool))] + [(r.name, r.snapshot()) for r in REPLICAS]
+        for name, snapshot in pools:
+            for key, value in snapshot.items():
+                value = int(value) if isinstance(value, bool) else value
+                lines.append('{}_pool{{engine="{}",stat="{}"}} {!r}'.format(ns, name, key, value))
+        lines.append('# TYPE {}_response_cache gauge'.format(ns))
+        for key in ['hits', 'misses', 'evictions', 'invalidations', 'size']:
+            lines.append('{}_response_cache{{stat="{}"}} {}'.format(ns, key, getattr(RESPONSE_CACHE, key)))
+        lines.append('{}_response_cache{{stat="entries"}} {}'.format(ns, len(RESPONSE_CACHE.entries)))
+        lines.append('# TYPE {}_statement_cache gauge'.format(ns))
+        statements = sum(len(d.statements) for d in REGISTRY.values())
+        lines.append('{}_statement_cache{{stat="statements"}} {}'.format(ns, statements))
+        lines.append('{}_statement_cache{{stat="compiled"}} {}'.format(ns, len(COMPILED_CACHE)))
+        if SEARCH_INDEXES:
+            lines.append('# TYPE {}_search_index gauge'.format(ns))
+        for resource, indexes in SEARCH_INDEXES.items():
+            for key, index in indexes.items():
+                for stat, value in index.snapshot().items():
+                    value = int(value) if isinstance(value, bool) else value
+                    lines.append(
+                        '{}_search_index{{table="{}",column="{}",stat="{}"}} {!r}'.format(
+                            ns, resource, key, stat, 0 if value is None else value
+                        )
+                    )
+        if PRIVILEGES is not None:
+            lines.append('# TYPE {}_privileges gauge'.format(ns))
+            for stat, value in PRIVILEGES.snapshot().items():
+                lines.append('{}_privileges{{stat="{}"}} {}'.format(ns, stat, value))
+        return '\n'.join(lines) + '\n'
+
+
+STATS = RequestStats()
+
+
+def stats_resource():
+    # type: () -> str
+    # only real tables make it into the labels, anybody can make up a url
+    if request.url_rule is None:
+        return '_unknown'
+    resource = (request.view_args or {}).get('resource')
+    if resource is None:
+        return request.endpoint
+    resource = resource.lower()
+    return resource if resource in REGISTRY or resource in TABLE_NAMES else '_unknown'
+
+
+@app.before_request
+def start_timings():
+    if STATS.sampled():
+        g.timings = Timings()
+
+
+@app.after_request
+def finish_timings(response):
+    timings = g.get('timings')
+    if timings is not None:
+        timings.finish()
+        STATS.record(stats_resource(), request.method, timings, response.calculate_content_length())
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    # whatever didn't come out of the response cache already compressed, registered after finish_timings so it
+    # runs before it, and the bytes that get counted are the ones that go out
+    if (
+        not ENCODINGS or response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers
+        or response.status_code < 200 or response.status_code in [204, 304] or request.method == 'HEAD'
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed:
+        encoding = accepted_encoding(response.mimetype, COMPRESS_MIN_BYTES)
+        if encoding is not None:
+            response.response = compress_stream(response.response, encoding)
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Length', None)
+        return response
+    body = response.get_data()
+    encoding = accepted_encoding(response.mimetype, len(body))
+    if encoding is not None:
+        with span('compress'):
+            response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 
 @app.route('/favicon.ico')
@@ -343,20 +2815,19 @@ def favicon():
     )
 
 
-METADATA_SERIALIZED = None
-
-
 @app.route('/api/{}/metadata'.format(API_VERSION), methods=['GET'])
+@retries_on_primary
 def metadata_endpoint():
-    global METADATA_SERIALIZED
-    if METADATA_SERIALIZED is None:
-        tables = set(filter(lambda x: not x.startswith('__'), dir(BASE.classes)))
+    entry = RESPONSE_CACHE.get(METADATA_CACHE_KEY)
+    if entry is None:
+        generation = RESPONSE_CACHE.generation(METADATA_CACHE_KEY[0])
+        # the whole document means the whole schema, lazy or not
+        reflect_tables(list(TABLE_NAMES.values()), bind=read_engine())
         dick = OrderedDict()
-        for table in tables:
-            _, introspection, column_map, primary_key_map = inspect_table(table)
+        for descriptor in REGISTRY.values():
             table_dick = OrderedDict()
             columns = OrderedDict()
-            for i, c in enumerate(introspection.columns):
+            for i, c in enumerate(descriptor.columns):
                 col_dick = dict(position=i, type=c.type.__class__.__name__, name=c.name)
                 if hasattr(c.type, 'length'):
                     col_dick['length'] = c.type.length
@@ -364,22 +2835,65 @@ def metadata_endpoint():
                     col_dick['length'] = None
                 columns[c.name] = col_dick
             table_dick['columns'] = columns
-            table_dick['primary_key_map'] = primary_key_map
-            table_dick['column_map'] = column_map
-            dick[table] = table_dick
-        METADATA_SERIALIZED = dick
+            table_dick['primary_key_map'] = descriptor.primary_key_map
+            table_dick['column_map'] = descriptor.column_map
+            dick[descriptor.name] = table_dick
+        response = jsonify(dick)
+        # only a schema refresh changes it, so no ttl
+        entry = RESPONSE_CACHE.put(METADATA_CACHE_KEY, response.get_data(), response.mimetype, {}, generation, ttl=None)
+
+    return cached_response(entry)
+
+
+@app.route('/api/{}/_pool'.format(API_VERSION), methods=['GET'])
+def pool_endpoint():
+    dick = ENGINE.pool.stats.snapshot(ENGINE.pool)
+    if REPLICAS:
+        dick['replicas'] = OrderedDict((r.name, r.snapshot()) for r in REPLICAS)
+    return jsonify(dick)
 
-    return jsonify(METADATA_SERIALIZED)
 
+@app.route('/api/{}/_stats'.format(API_VERSION), methods=['GET'])
+def stats_endpoint():
+    return Response(STATS.prometheus(), mimetype='text/plain; version=0.0.4')
 
-PERMISSIONS_SERIALIZED = None
+
+@app.route('/api/{}/_refresh'.format(API_VERSION), methods=['POST'])
+def refresh_endpoint():
+    try:
+        refresh_registry()
+    except Exception as e:
+        return jsonify(error=str(e), traceback=traceback.format_exc())
+    return jsonify(known_tables())
+
+
+@app.route('/api/{}/_reindex'.format(API_VERSION), methods=['POST'])
+def reindex_endpoint():
+    # rebuild the --search-index's from scratch, all of them or just resource='s, after writes that went around
+    # the api. they rebuild on their own after anything else they couldn't follow
+    resource = request.args.get('resource', None)
+    dick = OrderedDict()
+    try:
+        if resource is not None and resource.lower() not in SEARCH_INDEXES:
+            raise RuntimeError('{!r} has no search indexes, these do: {}'.format(resource, list(SEARCH_INDEXES)))
+        for name, indexes in SEARCH_INDEXES.items():
+            if resource is None or name == resource.lower():
+                for key, index in indexes.items():
+                    dick['{}.{}'.format(name, key)] = index.rebuild()
+                RESPONSE_CACHE.invalidate(name)
+                announce_write(name)
+    except Exception as e:
+        return jsonify(error=str(e), traceback=traceback.format_exc())
+    return jsonify(dick)
 
 
 @app.route('/api/{}/permissions'.format(API_VERSION), methods=['GET'])
+@retries_on_primary
 def permissions_endpoint():
-    global PERMISSIONS_SERIALIZED
-    if PERMISSIONS_SERIALIZED is None:
-        session = get_session()
+    entry = RESPONSE_CACHE.get(PERMISSIONS_CACHE_KEY)
+    if entry is None:
+        generation = RESPONSE_CACHE.generation(PERMISSIONS_CACHE_KEY[0])
+        session = get_session(read_engine())
         rows = []
         result_proxy = session.execute(MSSQL_PERMISSIONS)
         for row_proxy in result_proxy:
@@ -387,91 +2901,347 @@ def permissions_endpoint():
             for k, v in row_proxy.items():
                 dick[k] = v
             rows.append(dick)
-        PERMISSIONS_SERIALIZED = rows
+        response = jsonify(rows)
+        entry = RESPONSE_CACHE.put(
+            PERMISSIONS_CACHE_KEY, response.get_data(), response.mimetype, {}, generation, ttl=PERMISSIONS_TTL
+        )
 
-    return jsonify(PERMISSIONS_SERIALIZED)
+    return cached_response(entry)
 
 
-@app.route('/api/{}/<resource>'.format(API_VERSION), methods=['GET', 'POST', 'OPTIONS'])
+@app.route('/api/{}/<resource>/_aggregate'.format(API_VERSION), methods=['GET'])
+@retries_on_primary
+def aggregate_endpoint(resource):
+    # one aggregate query over the same filters as a GET, instead of shipping the rows to count them somewhere else
+    engine = read_engine()
+    session = get_session(engine)
+    try:
+        descriptor = lookup_table(resource)
+        with span('parse'):
+            q = parse_query_params()
+        cache_key = (descriptor.name.lower(), '_aggregate', request.host, q.cache_key())
+        entry = RESPONSE_CACHE.get(cache_key)
+        if entry is not None:
+            session.close()
+            return cached_response(entry)
+        generation = RESPONSE_CACHE.generation(cache_key[0])
+        params = criteria_params(descriptor, q)
+        shape = ('_aggregate', q.aggregates, q.group_by, where_shape(q), q.limit)
+        statement = descriptor.statements.get(shape)
+        if statement is None:
+            statement = aggregate_statement(descriptor, q)
+            descriptor.cache_statement(shape, statement)
+        with span('sql'):
+            result_proxy = execute_cached(session, statement, params)
+        with span('fetch'):
+            labels = result_proxy.keys()
+            result_rows = result_proxy.fetchall()
+        note_rows(len(result_rows))
+        with span('serialize'):
+            encoded = dumps([_row_dict(zip(labels, row)) for row in result_rows])
+    except Exception as e:
+        session.close()
+        return jsonify(error=str(e), traceback=traceback.format_exc())
+
+    ttl = 0 if lagging(engine, cache_key[0]) else -1
+    return cached_response(RESPONSE_CACHE.put(cache_key, encoded, 'application/json', {}, generation, ttl=ttl))
+
+
+@app.route('/api/{}/<resource>/_changes'.format(API_VERSION), methods=['GET'])
+def changes_endpoint(resource):
+    # the rows inserted or updated after since=, in the order they changed, and the primary keys deleted after it.
+    # no since= starts from the beginning, a page at a time, wait=<seconds> holds on until there's something.
+    # always off the primary, a replica could hand back a row the tombstones already said was gone
+    try:
+        descriptor = lookup_table(resource)
+        feed = CHANGE_FEEDS.get(descriptor.name.lower())
+        if feed is None:
+            raise RuntimeError('{!r} has no change feed, these do: {}'.format(resource, list(CHANGE_FEEDS)))
+        if not descriptor.primary_key:
+            raise RuntimeError('{!r} has no primary key to tell the rows apart by.'.format(descriptor.name))
+        with span('parse'):
+            q = parse_query_params()
+            wait = float(request.args.get('wait') or 0)
+            if not 0 <= wait <= CHANGES_MAX_WAIT:
+                raise ValueError('wait has to be between 0 and {} seconds!'.format(CHANGES_MAX_WAIT))
+            limit = CHANGES_LIMIT if q.limit is None else q.limit
+            projection = descriptor.project(q.fields)
+            # the change column first and the primary key to break its ties, like a cursor
+            key_columns = [filter_column(descriptor, feed.key)] + list(descriptor.primary_key)
+            since = request.args.get('since') or None
+            if since is None:
+                values, epoch, sequence = None, feed.epoch, None
+            else:
+                values, epoch, sequence = decode_since(since, len(key_columns))
+
+        shape = ('_changes', projection.keys, None if values is None else tuple(v is None for v in values), limit)
+        statement = descriptor.statements.get(shape)
+        if statement is None:
+            statement = select(
+                list(projection.columns) + [c.label('_c{}'.format(i)) for i, c in enumerate(key_columns)]
+            )
+            if values is not None:
+                statement = statement.where(keyset_criterion(key_columns, values, False))
+            if ENGINE.dialect.name == 'mssql' and isinstance(key_columns[0].type, mssql.TIMESTAMP):
+                # nothing past a transaction still in flight, or its rows would show up behind the token later
+                statement = statement.where(key_columns[0] < func.min_active_rowversion())
+            statement = statement.order_by(*[c.asc() for c in key_columns]).limit(limit + 1)
+            descriptor.cache_statement(shape, statement)
+        params = keyset_params(values or [])
+
+        deadline = time.time() + wait
+        while True:
+            writes = feed.writes
+            if sequence is None:  # starting over, there's nothing to have deleted yet
+                deleted, latest, complete = [], feed.latest(), True
+            else:
+                deleted, latest, complete = feed.deletes_since(epoch, sequence)
+            session = get_session(ENGINE)
+            with span('sql'):
+                result_rows = execute_cached(session, statement, params).fetchall()
+            session.close()  # nobody waits holding onto a connection
+            remaining = deadline - time.time()
+            if result_rows or deleted or not complete or remaining <= 0:
+                break
+            feed.wait(writes, min(remaining, CHANGES_POLL))
+
+        more = len(result_rows) > limit
+        result_rows = result_rows[:limit]
+        if result_rows:
+            values = list(result_rows[-1][len(projection.keys):])
+        note_rows(len(result_rows))
+        with span('serialize'):
+            encoded = dumps(
+                OrderedDict([
+                    ('changes', projection.dicts(result_rows)),
+                    ('deleted', deleted),
+                    ('complete', complete),  # false means deletes could've been missed, start over to be sure
+                    ('more', more),
+                    ('next', encode_since(values, feed.epoch, latest)),
+                ])
+            )
+    except Exception as e:
+        return jsonify(error=str(e), traceback=traceback.format_exc())
+    return Response(encoded, mimetype='application/json')
+
+
+@app.route('/api/{}/<resource>/_export'.format(API_VERSION), methods=['GET'])
+@retries_on_primary
+def export_endpoint(resource):
+    # the same filters, search, fields and order as a GET, as an arrow ipc stream instead of json rows
+    engine = read_engine()
+    session = get_session(engine)
+    try:
+        if pyarrow is None:
+            raise ImportError('_export needs "pip install pyarrow", stream=1 on a GET does NDJSON without it')
+        descriptor = lookup_table(resource)
+        with span('parse'):
+            q = parse_query_params()
+            batch_size = int(request.args.get('batch_size') or EXPORT_BATCH_SIZE)
+            if batch_size < 1:
+                raise ValueError('batch_size must be at least 1!')
+            # compressed buffers, which arrow readers undo on their own, at the cost of reading them in place
+            compression = request.args.get('compression') or None
+            if compression is not None and (
+                compression not in EXPORT_COMPRESSIONS or not pyarrow.Codec.is_available(compression)
+            ):
+                raise ValueError('compression has to be one of {} this pyarrow has'.format(EXPORT_COMPRESSIONS))
+        projection = descriptor.project(q.fields)
+        params = criteria_params(descriptor, q)
+        shape = ('_export', projection.keys, where_shape(q), q.order, q.order_key, q.limit)
+        statement = descriptor.statements.get(shape)
+        if statement is None:
+            statement = select(list(projection.columns))
+            for criterion in build_criteria(descriptor, q):
+                statement = statement.where(criterion)
+            if q.order is not None:
+                column = descriptor.table.c[descriptor.column_map[q.order_key]]
+                statement = statement.order_by(column.desc() if q.order == 'desc' else column.asc())
+            if q.limit is not None:
+                statement = statement.limit(q.limit)
+            statement = statement.execution_options(stream_results=True)
+            descriptor.cache_statement(shape, statement)
+    except Exception as e:
+        session.close()
+        return jsonify(error=str(e), traceback=traceback.format_exc())
+    return Response(
+        stream_with_context(export_rows(session, statement, params, projection, batch_size, compression)),
+        mimetype=ARROW_MIMETYPE
+    )
+
+
+def invalidates_cache(view):
+    # anything that might have written to a table throws out whatever was cached for it, failures included,
+    # since a bulk load can fail halfway through with half its batches committed
+    @functools.wraps(view)
+    def wrapper(resource, id_=None):
+        try:
+            return view(resource, id_)
+        finally:
+            if request.method in WRITE_METHODS:
+                RESPONSE_CACHE.invalidate(resource.lower())
+                announce_write(resource)
+                wake_pollers(resource)
+
+    return wrapper
+
+
+@app.route('/api/{}/<resource>'.format(API_VERSION), methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'])
 @app.route('/api/{}/<resource>/<id_>'.format(API_VERSION), methods=['GET', 'PUT', 'DELETE', 'OPTIONS'])
+@invalidates_cache
+@retries_on_primary
 def generic_endpoint(resource, id_=None):
-    tables = set(filter(lambda x: not x.startswith('__'), dir(BASE.classes)))
-    session = get_session()
+    engine = read_engine() if request.method == 'GET' else ENGINE
+    session = get_session(engine)
     rows = []
+    encoded = None  # GETs encode straight from the result tuples
+    headers = {}
+    cache_key = None
     try:
-        if resource not in tables:
-            raise RuntimeError('{!r} not in {}'.format(resource, tables))
-
-        TABLE, _, column_map, primary_key_map = inspect_table(resource)
+        descriptor = lookup_table(resource)
+        TABLE = descriptor.TABLE
+        column_map, primary_key_map = descriptor.column_map, descriptor.primary_key_map
 
         if request.method == 'GET':
-            query = session.query(TABLE)
+            # core all the way, tuples straight off the cursor, no orm objects and no identity map
+            with span('parse'):
+                q = parse_query_params()
+            if not q.stream:
+                cache_key = (descriptor.name.lower(), id_, request.host, q.cache_key())
+                entry = RESPONSE_CACHE.get(cache_key)
+                if entry is not None:
+                    session.close()
+                    return cached_response(entry)
+                generation = RESPONSE_CACHE.generation(cache_key[0])
+            projection = descriptor.project(q.fields)
+            # the shape of the query picks the statement, the values only ever go in as parameters, so a shape
+            # that's been seen before skips building the statement here and compiling it in sqlalchemy
+            keys, key_columns, key_positions, extra_columns, values = [], [], [], [], None
+            direction, descending, ordered, limit, stream = 'next', False, False, None, False
 
             if id_ is not None:  # route b
                 if 'id' not in primary_key_map:
                     raise RuntimeError('{!r} is gonna need something custom to deal with offset.'.format(resource))
-                id_column = getattr(TABLE, primary_key_map['id'])
-                query = query.filter(id_column == id_)
+                params = dict(_id=id_)
 
             else:  # route a
-                q = parse_query_params()
-                if q.offset is not None:
-                    if 'id' not in primary_key_map:
-                        raise RuntimeError('{!r} is gonna need something custom to deal with offset.'.format(resource))
-                    id_column = getattr(TABLE, primary_key_map['id'])
-                    query = query.filter(id_column >= q.offset)
-
-                if q.search is not None:
-                    if q.search_key not in column_map:
-                        raise RuntimeError(
-                            '{!r} is not a real column for {!r}! these are: {}'.format(
-                                q.search_key, resource, list(column_map.keys())
-                            )
-                        )
-                    key_column = getattr(TABLE, column_map[q.search_key])
-                    query = query.filter(key_column.like(q.search))
-
-                if q.order is not None:
-                    if q.order_key not in column_map:
-                        raise RuntimeError(
-                            '{!r} is not a real column for {!r}! these are: {}'.format(
-                                q.order_key, resource, list(column_map.keys())
-                            )
-                        )
-                    sort_column = getattr(TABLE, column_map[q.order_key])
-                    if q.order == 'asc':
-                        query = query.order_by(sort_column.asc())
+                where_params = criteria_params(descriptor, q)
+                params = dict(where_params)
+                keys = keyset_keys(resource, q, column_map, primary_key_map)
+                order = q.order or 'asc'
+                if q.cursor is not None and not keys:
+                    raise RuntimeError('{!r} has no primary key to build a cursor out of.'.format(resource))
+                key_columns = [descriptor.table.c[column_map[k]] for k in keys]
+                # the cursor needs the keys whether or not they were asked for, they just don't make it into the rows
+                width = len(projection.keys)
+                for k, column in zip(keys, key_columns):
+                    if k in projection.keys:
+                        key_positions.append(projection.keys.index(k))
                     else:
-                        query = query.order_by(sort_column.desc())
-
+                        extra_columns.append(column)
+                        key_positions.append(width)
+                        width += 1
+                if q.cursor is not None:
+                    direction, values = decode_cursor(q.cursor, keys, order)
+                    params.update(keyset_params(values))
+                # walking backwards is just walking forwards with the order flipped, then flipping the page back
+                descending = (order == 'desc') != (direction == 'prev')
+                ordered = q.order is not None or q.cursor is not None or q.limit is not None
+                stream = q.stream
                 if q.limit is not None:
-                    query = query.limit(q.limit)
+                    limit = q.limit if stream else q.limit + 1  # the extra one says whether theres another page
+
+            shape = (
+                id_ is not None, projection.keys, where_shape(q) if id_ is None else None, tuple(keys), descending,
+                ordered, None if values is None else tuple(v is None for v in values), limit, stream
+            )
+            statement = descriptor.statements.get(shape)
+            if statement is None:
+                statement = select(list(projection.columns) + extra_columns)
+                if id_ is not None:
+                    id_column = descriptor.table.c[primary_key_map['id']]
+                    statement = statement.where(id_column == bindparam('_id', type_=id_column.type))
+                else:
+                    for criterion in build_criteria(descriptor, q):
+                        statement = statement.where(criterion)
+                if values is not None:
+                    statement = statement.where(keyset_criterion(key_columns, values, descending))
+                if ordered:
+                    statement = statement.order_by(*[c.desc() if descending else c.asc() for c in key_columns])
+                if limit is not None:
+                    statement = statement.limit(limit)
+                if stream:
+                    statement = statement.execution_options(stream_results=True)
+                descriptor.cache_statement(shape, statement)
+
+            if stream:
+                return Response(
+                    stream_with_context(
+                        stream_rows(session, statement, params, projection, reverse=direction == 'prev')
+                    ),
+                    mimetype=NDJSON_MIMETYPE
+                )
 
-            proxy_rows = query.all()
-            if proxy_rows:
-                for row in proxy_rows:
-                    rows.append({k: getattr(row, k) for k in column_map})
+            with span('sql'):
+                result_proxy = execute_cached(session, statement, params)
+            with span('fetch'):
+                result_rows = result_proxy.fetchall()
+            note_rows(len(result_rows))
+            if id_ is None and q.total:
+                with span('sql'):
+                    headers['X-Total-Count'] = str(total_count(session, descriptor, q, where_params))
+            if id_ is None and q.limit is not None and len(result_rows) > q.limit:
+                more = True
+                result_rows = result_rows[:q.limit]
+            else:
+                more = False
+            if id_ is None and direction == 'prev':
+                result_rows.reverse()
+            with span('serialize'):
+                encoded = projection.dumps(result_rows)
+            if result_rows:
+                if id_ is None and keys:
+                    first = [result_rows[0][i] for i in key_positions]
+                    last = [result_rows[-1][i] for i in key_positions]
+                    if (direction == 'next' and more) or (direction == 'prev' and q.cursor is not None):
+                        headers['X-Next-Cursor'] = encode_cursor(keys, order, 'next', last)
+                    if (direction == 'prev' and more) or (direction == 'next' and q.cursor is not None):
+                        headers['X-Prev-Cursor'] = encode_cursor(keys, order, 'prev', first)
+                    links = []
+                    if 'X-Next-Cursor' in headers:
+                        links.append('<{}>; rel="next"'.format(cursor_url(headers['X-Next-Cursor'])))
+                    if 'X-Prev-Cursor' in headers:
+                        links.append('<{}>; rel="prev"'.format(cursor_url(headers['X-Prev-Cursor'])))
+                    if links:
+                        headers['Link'] = ', '.join(links)
 
         elif request.method == 'POST':
-            if id_ is None:  # route a
+            if id_ is None and request.mimetype == NDJSON_MIMETYPE:  # route a, in bulk, a line at a time
+                q = parse_query_params()
+                body = ndjson_lines(request.stream)
+                with span('sql'):
+                    summary = bulk_insert(session, descriptor, body, q.batch_size, q.on_conflict)
+                note_rows(summary['inserted'] + summary['updated'])
+                return jsonify(summary)
+
+            elif id_ is None:  # route a
                 # this is correct and good
                 body = request.data  # comes as a string or None
                 if body is None:
                     raise ValueError('POST expects a body! got back nothing!')
                 body = json.loads(body)
-                sanitized = {}
-                for k, v in body.items():
-                    if k not in column_map:
-                        raise RuntimeError(
-                            '{!r} is not a real column for {!r}! these are: {}'.format(
-                                k, resource, list(column_map.keys())
-                            )
-                        )
-                    sanitized[column_map[k]] = v
-                orm_object = TABLE(**sanitized)
+                if isinstance(body, list):  # in bulk
+                    q = parse_query_params()
+                    with span('sql'):
+                        summary = bulk_insert(session, descriptor, body, q.batch_size, q.on_conflict)
+                    note_rows(summary['inserted'] + summary['updated'])
+                    return jsonify(summary)
+                orm_object = TABLE(**sanitize_body(descriptor, body))
                 session.add(orm_object)
                 session.commit()
-                rows.append({k: getattr(orm_object, k) for k in column_map})
+                values = descriptor.getter(orm_object)
+                index_rows(descriptor, [dict(zip([c.name for c in descriptor.columns], values))])
+                rows.append(descriptor.serialize(values))
                 session.expunge(orm_object)  # otherwise it'll hold onto it, driving memory up
 
             else:  # route b
@@ -482,80 +3252,537 @@ def generic_endpoint(resource, id_=None):
                 )
 
         elif request.method == 'PUT':
-            if id_ is None:  # route a
-                # this is awful and wrong
-                raise RuntimeError(
-                    'thou shalt not {} to a {} like you just did at {}!'.format(
-                        request.method, request.url_rule.rule, request.path
-                    )
-                )
-            else:
-                query = session.query(TABLE)
+            body = request.data  # comes as a string or None
+            if not body:
+                raise ValueError('PUT expects a body! got back nothing!')
+            sanitized = sanitize_body(descriptor, json.loads(body))
+
+            if id_ is None:  # route a, one UPDATE ... WHERE for everything the filters match
+                q = parse_query_params()
+                criteria, params = bulk_criteria(descriptor, q), criteria_params(descriptor, q)
+                if q.dry_run:
+                    return jsonify(matched=count_where(session, descriptor, criteria, params), dry_run=True)
+                statement = descriptor.table.update().values(sanitized)
+                for criterion in criteria:
+                    statement = statement.where(criterion)
+                with span('sql'):
+                    keys = touched_keys(session, descriptor, criteria, params, sanitized)
+                    updated = session.execute(statement, params).rowcount
+                    session.commit()
+                if keys is not None:
+                    pk_name = descriptor.primary_key[0].name
+                    index_rows(descriptor, [dict(sanitized, **{pk_name: key}) for key in keys])
+                note_rows(updated)
+                return jsonify(updated=updated)
+
+            else:  # route b
                 if 'id' not in primary_key_map:
                     raise RuntimeError('{!r} is gonna need something custom to deal with offset.'.format(resource))
-                id_column = getattr(TABLE, primary_key_map['id'])
-                query = query.filter(id_column == id_)
-                orm_object = query.all()
-
-                if orm_object:
-                    body = request.data  # comes as a string or None
-                    if body is None:
-                        raise ValueError('POST expects a body! got back nothing!')
-                    body = json.loads(body)
-                    for k, v in body.items():
-                        if k not in column_map:
-                            raise RuntimeError(
-                                '{!r} is not a real column for {!r}! these are: {}'.format(
-                                    k, resource, list(column_map.keys())
-                                )
-                            )
-                        setattr(orm_object, column_map[k], v)
-                    session.commit()
-                    rows.append({k: getattr(orm_object, k) for k in column_map})
-                    session.expunge(orm_object)  # otherwise it'll hold onto it, driving memory up
+                id_column = descriptor.table.c[primary_key_map['id']]
+                statement = descriptor.table.update().where(id_column == id_).values(sanitized)
+                updated = session.execute(statement).rowcount
+                session.commit()
+                if updated:
+                    key = sanitized.get(id_column.name, id_)  # the body can move the row to a new id
+                    row = session.execute(select(list(descriptor.columns)).where(id_column == key)).first()
+                    if id_column.name in sanitized:
+                        unindex_keys(descriptor, [coerce_value(id_column, id_)])  # it's not there anymore
+                    if row is not None:
+                        index_rows(descriptor, [dict(zip([c.name for c in descriptor.columns], row))])
+                        rows.append(descriptor.serialize(row))
 
         elif request.method == 'DELETE':
-            if id_ is None:  # route a
-                # this is awful and wrong
-                raise RuntimeError(
-                    'thou shalt not {} to a {} like you just did at {}!'.format(
-                        request.method, request.url_rule.rule, request.path
-                    )
-                )
-            else:
-                query = session.query(TABLE)
+            if id_ is None:  # route a, one DELETE ... WHERE for everything the filters match
+                q = parse_query_params()
+                criteria, params = bulk_criteria(descriptor, q), criteria_params(descriptor, q)
+                if q.dry_run:
+                    return jsonify(matched=count_where(session, descriptor, criteria, params), dry_run=True)
+                statement = descriptor.table.delete()
+                for criterion in criteria:
+                    statement = statement.where(criterion)
+                with span('sql'):
+                    keys = touched_keys(session, descriptor, criteria, params)
+                    deleted = session.execute(statement, params).rowcount
+                    session.commit()
+                if keys is not None:
+                    unindex_keys(descriptor, keys)
+                    record_deletes(descriptor, keys)
+                note_rows(deleted)
+                return jsonify(deleted=deleted)
+
+            else:  # route b
                 if 'id' not in primary_key_map:
                     raise RuntimeError('{!r} is gonna need something custom to deal with offset.'.format(resource))
-                id_column = getattr(TABLE, primary_key_map['id'])
-                query = query.filter(id_column == id_)
-                orm_object = query.all()
-
-                if orm_object:
-                    session.delete(orm_object)
+                id_column = descriptor.table.c[primary_key_map['id']]
+                keys = touched_keys(session, descriptor, [id_column == id_], {})
+                deleted = session.execute(descriptor.table.delete().where(id_column == id_)).rowcount
+                session.commit()
+                if deleted:
+                    if keys is not None:
+                        unindex_keys(descriptor, keys)
+                        record_deletes(descriptor, keys)
                     rows.append(id_)
 
     except Exception as e:
         session.close()
         return jsonify(error=str(e), traceback=traceback.format_exc())
 
-    return jsonify(rows)
+    with span('serialize'):
+        if encoded is None:
+            encoded = dumps(rows)
+        response = Response(encoded, mimetype='application/json')
+    response.headers.extend(headers)
+    if cache_key is not None:
+        ttl = 0 if lagging(engine, cache_key[0]) else -1
+        response = cached_response(
+            RESPONSE_CACHE.put(cache_key, response.get_data(), response.mimetype, headers, generation, ttl=ttl)
+        )
+    return response
+
+
+@app.route('/api/{}/_batch'.format(API_VERSION), methods=['POST'])
+def batch_endpoint():
+    # [{"method": "PUT", "resource": "people", "id": 3, "params": {...}, "body": {...}}, ...] or
+    # {"transaction": true, "operations": [...]}. every operation goes through the very same view its own
+    # request would have, in a request context of its own, sharing this request's session
+    try:
+        body = json.loads(request.data or 'null')
+        transaction = _parse_flag(request.args.get('transaction', None))
+        if isinstance(body, dict):
+            transaction = transaction or bool(body.get('transaction'))
+            body = body.get('operations')
+        if not isinstance(body, list):
+            raise ValueError('POST expects a list of operations, or {"operations": [...]}!')
+        if len(body) > BATCH_MAX_OPERATIONS:
+            raise ValueError('{} operations is more than {} in one go!'.format(len(body), BATCH_MAX_OPERATIONS))
+        operations = [batch_operation(op) for op in body]
+    except Exception as e:
+        return jsonify(error=str(e), traceback=traceback.format_exc())
+
+    # everything gets checked before anything runs, and a transaction that would fail on privileges never starts
+    denials = [operation_denied(op) for op in operations]
+    if transaction and any(denials):
+        first = next(i for i, denied in enumerate(denials) if denied)
+        encoded = []
+        for denied in denials:
+            status, error = denied or (424, 'operation {} is not allowed, so none of them ran'.format(first))
+            encoded.append(batch_result(status, {}, error))
+        return Response(b'[' + b','.join(encoded) + b']', mimetype='application/json')
+
+    written = set(op['resource'].lower() for op in operations if op['method'] in WRITE_METHODS)
+    g.wrote = bool(written)
+    connection = None
+    if transaction:
+        # the session rides a transaction begun out here, so each view's commit() only ends a subtransaction
+        # and nothing lands until everything worked, and the first failure rolls all of it back
+        connection = ENGINE.connect()
+        outer = connection.begin()
+        get_session(connection)
+        g.pending_deletes = []
+    else:
+        get_session(ENGINE if written else read_engine())
+
+    results, failed = [], None
+    try:
+        for i, op in enumerate(operations):
+            if failed is not None:
+                results.append((424, {}, 'operation {} failed, so this one never ran'.format(failed)))
+                continue
+            if denials[i] is not None:
+                status, headers, body, ok = denials[i][0], {}, denials[i][1], False
+            else:
+                status, headers, body, ok = run_operation(op)
+            results.append((status, headers, body))
+            if transaction and not ok:
+                failed = i
+        if transaction:
+            if failed is None:
+                outer.commit()
+                for feed, keys in g.pending_deletes:
+                    feed.deleted(keys)
+            else:
+                outer.rollback()
+                for resource in written:
+                    stale_indexes(resource)  # they heard about writes that never happened
+    finally:
+        if connection is not None:
+            SESSION.remove()
+            connection.close()
+        for resource in written:
+            RESPONSE_CACHE.invalidate(resource)  # again, now that it's committed, or not
+            announce_write(resource)
+            wake_pollers(resource)
+
+    encoded = [
+        batch_result(status, headers, body, rolled_back=failed is not None and i < failed)
+        for i, (status, headers, body) in enumerate(results)
+    ]
+    return Response(b'[' + b','.join(encoded) + b']', mimetype='application/json')
+
+
+def batch_operation(op):
+    # type: (dict) -> dict
+    if not isinstance(op, dict) or not op.get('resource'):
+        raise ValueError(
+            'operations look like {{"method": ..., "resource": ..., "id": ..., "params": ..., "body": ...}}, '
+            'got {!r}'.format(op)
+        )
+    op = dict(op)
+    op['method'] = str(op.get('method') or 'GET').upper()
+    op['path'] = '/api/{}/{}'.format(API_VERSION, quote(str(op['resource']), safe=''))
+    if op.get('id') is not None:
+        op['path'] += '/{}'.format(quote(str(op['id']), safe=''))
+    if not isinstance(op.get('params') or {}, dict):
+        raise ValueError('params has to be an object, got {!r}'.format(op['params']))
+    return op
+
+
+def batch_result(status, headers, body, rolled_back=False):
+    # type: (int, dict, object, bool) -> bytes
+    # a view's body is spliced in as is, its already json, a string is an error of the batch's own
+    if not isinstance(body, bytes):
+        body = dumps(dict(error=body))
+    head = dumps(OrderedDict([('status', status), ('headers', headers), ('rolled_back', rolled_back)]))
+    return head[:-1] + b',"body":' + body + b'}'
+
+
+def operation_denied(op):
+    # type: (dict) -> tuple
+    try:
+        endpoint, view_args = app.create_url_adapter(request).match(op['path'], method=op['method'])
+    except HTTPException:
+        return None  # run_operation says what's wrong with it
+    return privilege_denied(endpoint, op['method'], view_args, op.get('params') or {})
+
+
+def run_operation(op):
+    # type: (dict) -> tuple
+    data = None if 'body' not in op else dumps(op['body'])
+    with app.test_request_context(
+        op['path'],
+        method=op['method'],
+        query_string=op.get('params') or {},
+        data=data,
+        content_type='application/json',
+        base_url=request.host_url
+    ):
+        if request.routing_exception is not None:
+            return request.routing_exception.code, {}, request.routing_exception.description, False
+        if request.url_rule.endpoint not in BATCH_ENDPOINTS:
+            return 400, {}, '{} {} cant be batched'.format(op['method'], op['path']), False
+        response = app.make_response(app.view_functions[request.url_rule.endpoint](**request.view_args))
+        body = response.get_data()
+        if response.mimetype == NDJSON_MIMETYPE:
+            body = b'[' + b','.join(line for line in body.split(b'\n') if line) + b']'
+        headers = dict((k, response.headers[k]) for k in BATCH_HEADERS if k in response.headers)
+    # the api answers most trouble with a 200 and an error document, and bulk POSTs with a count of failures
+    ok = response.status_code < 400
+    if ok and body[:1] == b'{':
+        dick = json.loads(body)
+        ok = 'error' not in dick and not dick.get('failed')
+    return response.status_code, headers, body, ok
+
+
+def serve(host, port, workers, max_requests=0, graceful_timeout=WORKER_GRACE):
+    # type: (str, int, int, int, float) -> int
+    # pre-fork: this process already reflected everything and built the search indexes, the workers get all of
+    # it copy-on-write and take turns accepting on one socket. SIGHUP re-reflects and swaps in fresh workers,
+    # SIGTERM or SIGINT stops, a worker that quits or dies gets replaced
+    global WRITES, _WRITES_SEEN
+    if not hasattr(os, 'fork'):
+        raise RuntimeError('--workers needs os.fork, which {} does not have'.format(sys.platform))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    WRITES = multiprocessing.Array('L', WRITE_SLOTS)
+    for feed in CHANGE_FEEDS.values():
+        feed.shared = multiprocessing.Value('L', feed.sequence)
+    _WRITES_SEEN = WRITES[:]
+    signals = []
+    for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+    current, retiring = {}, {}  # pid -> when it started, pid -> when it gets killed
+
+    def build():
+        for indexes in SEARCH_INDEXES.values():
+            for index in indexes.values():
+                try:
+                    index.rebuild()
+                except Exception:
+                    app.logger.exception('search index {}.{} did not build'.format(index.resource, index.key))
+        dispose_engines()
+
+    def spawn():
+        # the jitter keeps them all from recycling at once, and it has to be picked here, they'd all pick the same
+        limit = max_requests + random.randint(0, max_requests // 10) if max_requests else 0
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = run_worker(listener, host, port, limit)
+            except BaseException:
+                app.logger.exception('worker {} blew up'.format(os.getpid()))
+            finally:
+                os._exit(code)
+        current[pid] = time.time()
+
+    def retire(pids):
+        for pid in pids:
+            retiring[pid] = time.time() + graceful_timeout
+            os.kill(pid, signal.SIGTERM)
+
+    build()
+    for _ in range(workers):
+        spawn()
+    app.logger.info('serving on http://{}:{} with {} workers'.format(host, port, workers))
+    stopping = False
+    while current or retiring:
+        time.sleep(0.1)
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP and not stopping:
+                app.logger.info('reloading')
+                try:
+                    refresh_registry()
+                    build()
+                except Exception:
+                    app.logger.exception('reload failed, keeping the workers there are')
+                    continue
+                old = list(current)
+                current.clear()
+                for _ in range(workers):
+                    spawn()
+                retire(old)
+            elif signum != signal.SIGHUP and not stopping:
+                app.logger.info('stopping')
+                stopping = True
+                retire(list(current))
+                current.clear()
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:  # no children left
+                break
+            if pid == 0:
+                break
+            retiring.pop(pid, None)
+            started = current.pop(pid, None)
+            if started is not None and not stopping:
+                if time.time() - started < 1:
+                    time.sleep(1)  # dying right away will probably happen again, no need to spin on it
+                spawn()
+        for pid, deadline in list(retiring.items()):
+            if time.time() > deadline:
+                app.logger.warning('worker {} took longer than {}s to finish, killing it'.format(pid, graceful_timeout))
+                os.kill(pid, signal.SIGKILL)
+                retiring[pid] = float('inf')
+    listener.close()
+    return 0
+
+
+class WorkerRequestHandler(WSGIRequestHandler):
+    timeout = WORKER_KEEPALIVE  # an idle keep-alive connection can't hold up a worker that's on its way out
+
+
+def run_worker(listener, host, port, max_requests):
+    # type: (socket.socket, str, int, int) -> int
+    # serves until SIGTERM or max_requests, then lets whatever's in flight finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ctrl+c goes to the whole group, the master handles it
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    random.seed()  # otherwise every worker samples the very same requests
+    dispose_engines()
+    server = make_server(host, port, app, threaded=True, request_handler=WorkerRequestHandler, fd=listener.fileno())
+    server.daemon_threads = False  # so server_close() waits on the requests in flight
+    served = itertools.count(1)
+
+    def retire(*args):
+        global RETIRING
+        if not RETIRING:
+            RETIRING = True
+            # shutdown() waits on serve_forever, which is what the main thread (and so the signal) is in
+            threading.Thread(target=server.shutdown).start()
+
+    def wsgi_app(environ, start_response):
+        if max_requests and next(served) == max_requests:
+            retire()
+        return app(environ, start_response)
+
+    server.app = wsgi_app
+    signal.signal(signal.SIGTERM, retire)
+    app.logger.info(
+        'worker {} serving{}'.format(os.getpid(), ' {} requests'.format(max_requests) if max_requests else '')
+    )
+    server.serve_forever()
+    server.server_close()
+    app.logger.info('worker {} done'.format(os.getpid()))
+    return 0
 
 
 if __name__ == '__main__':
     description = '''{}
 
 Example "{}":
-{}'''.format(__doc__, CONF_FILEPATH, '\n'.join('    {}'.format(line) for line in str(MsSqlOdbc()).splitlines()))
+{}
+
+    # optional read replicas, as many as you like, anything left out comes from [odbc] but connection_string
+    [odbc:replica1]
+    server=replica1.example.com
+
+    # optional, what --privileges static (and auto, when this is here) goes by, for databases without grants
+    [privileges]
+    people=select,insert,update
+    *=select'''.format(
+        __doc__, CONF_FILEPATH, '\n'.join('    {}'.format(line) for line in str(MsSqlOdbc()).splitlines())
+    )
     parser = argparse.ArgumentParser(
         APP_NAME, formatter_class=argparse.RawDescriptionHelpFormatter, description=description
     )
     parser.add_argument(
         '--debug', action='store_true', help='ironically, disable the debug mode on flask for actual debugger reasons.'
     )
+    parser.add_argument('--config', default=CONF_FILEPATH, help='the config file, default "%(default)s"')
+    parser.add_argument(
+        '--reflect',
+        default='eager',
+        choices=REFLECT_MODES,
+        help='eager reflects everything up front, lazy reflects tables on first use, '
+        'cache loads a schema snapshot from "{}" and only reflects when the schema changed'.format(CACHE_DIRPATH)
+    )
+    parser.add_argument(
+        '--startup-only', action='store_true', help='stack it up, log how long that took, and quit, for measuring.'
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        type=float,
+        default=RESPONSE_CACHE_TTL,
+        help='seconds a cached GET lives, writes through the api drop it sooner, 0 turns it off, default %(default)s'
+    )
+    parser.add_argument(
+        '--cache-entries', type=int, default=RESPONSE_CACHE_ENTRIES, help='most cached GETs, default %(default)s'
+    )
+    parser.add_argument(
+        '--cache-megabytes',
+        type=int,
+        default=RESPONSE_CACHE_BYTES // 1024 // 1024,
+        help='most memory the cached GETs get, default %(default)s'
+    )
+    parser.add_argument(
+        '--stats-sample-rate',
+        type=float,
+        default=STATS_SAMPLE_RATE,
+        help='fraction of requests that get timed for /api/{}/_stats, default %(default)s'.format(API_VERSION)
+    )
+    parser.add_argument(
+        '--server-timing', action='store_true', help='put the timings of sampled requests in a Server-Timing header'
+    )
+    parser.add_argument(
+        '--json-backend',
+        choices=JSON_BACKENDS,
+        default=JSON_BACKEND,
+        help='what encodes the rows, orjson if it is installed, default "%(default)s"'
+    )
+    parser.add_argument(
+        '--read-your-writes',
+        type=float,
+        default=READ_YOUR_WRITES,
+        help='seconds a client reads from the primary after writing, with [odbc:<name>] replicas, default %(default)s'
+    )
+    parser.add_argument(
+        '--search-index',
+        default='',
+        help='comma separated <table>.<column>s that search= looks through an in-process trigram index for '
+        'instead of a LIKE scan, the table needs a single column primary key, rebuilt with POST /api/{}/_reindex'
+        .format(API_VERSION)
+    )
+    parser.add_argument('--host', default='127.0.0.1', help='default %(default)s')
+    parser.add_argument('--port', type=int, default=5000, help='default %(default)s')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='pre-fork this many worker processes after the schema is reflected and the caches are built, '
+        'SIGHUP reloads them, 0 is the flask dev server, default %(default)s'
+    )
+    parser.add_argument(
+        '--max-requests',
+        type=int,
+        default=0,
+        help='a worker gets replaced after about this many requests, 0 never, default %(default)s'
+    )
+    parser.add_argument(
+        '--graceful-timeout',
+        type=float,
+        default=WORKER_GRACE,
+        help='seconds a stopping worker gets to finish its requests, default %(default)s'
+    )
+    parser.add_argument(
+        '--changes',
+        default='',
+        help='comma separated <table>.<column>s that GET /api/{}/<table>/_changes?since= reports changes by, '
+        'a rowversion, a timestamp kept up on every write, or a key that only goes up'.format(API_VERSION)
+    )
+    parser.add_argument(
+        '--compress',
+        default=','.join(ENCODINGS),
+        help='comma separated content encodings to offer, best first, "" for none, default "%(default)s" '
+        '(zstd with "pip install zstandard", br with "pip install brotli")'
+    )
+    parser.add_argument(
+        '--compress-min-bytes',
+        type=int,
+        default=COMPRESS_MIN_BYTES,
+        help='responses smaller than this go out as is, default %(default)s'
+    )
+    parser.add_argument(
+        '--privileges',
+        default='auto',
+        choices=PRIVILEGE_MODES,
+        help='what every request on a table is checked against before it gets a session: mssql asks the database '
+        'what this login can do, static goes by the config\'s [privileges], auto is static when there is one, '
+        'mssql on mssql, and off otherwise, default "%(default)s"'
+    )
+    parser.add_argument(
+        '--privileges-ttl',
+        type=float,
+        default=PRIVILEGES_TTL,
+        help='seconds between looks at what the privileges are now, default %(default)s'
+    )
     args = parser.parse_args()
     app.logger.info('got args: {}'.format(vars(args)))
-
-    odbc = parse_config(CONF_FILEPATH)
+    STATS.sample_rate = args.stats_sample_rate
+    SERVER_TIMING = args.server_timing
+    if args.json_backend == 'orjson' and orjson is None:
+        raise ImportError('--json-backend orjson needs "pip install orjson"')
+    JSON_BACKEND = args.json_backend
+    READ_YOUR_WRITES = args.read_your_writes
+    SEARCH_INDEXES = parse_search_indexes(args.search_index) if args.search_index else {}
+    for encoding in [e.strip() for e in args.compress.split(',') if e.strip()]:
+        if encoding not in ENCODINGS:
+            raise ValueError('--compress {!r} is not one of the ones available: {}'.format(encoding, ENCODINGS))
+    ENCODINGS = [e.strip() for e in args.compress.split(',') if e.strip()]
+    COMPRESS_MIN_BYTES = args.compress_min_bytes
+    CHANGE_FEEDS = parse_change_feeds(args.changes) if args.changes else {}
+    RESPONSE_CACHE.ttl = args.cache_ttl
+    RESPONSE_CACHE.max_entries = args.cache_entries
+    RESPONSE_CACHE.max_bytes = args.cache_megabytes * 1024 * 1024
+
+    odbc = parse_config(args.config)
     app.logger.info('loading all of the nasty sql stuff')
-    stack_it_up(odbc.get_connection_string())
-    app.run(debug=not args.debug)
+    stack_it_up(
+        odbc.get_connection_string(),
+        schema=odbc.schema,
+        reflect=args.reflect,
+        replicas=[(r.name, r.get_connection_string(), r.get_pool_kwargs()) for r in odbc.replicas],
+        **odbc.get_pool_kwargs()
+    )
+    provider = privilege_provider(args.privileges, odbc.privileges, ENGINE, odbc.schema)
+    if provider is not None:
+        PRIVILEGES = PrivilegeLookup(provider, ttl=args.privileges_ttl)
+        app.logger.info('{} grants from {}'.format(PRIVILEGES.refresh(), provider.__class__.__name__))
+    if args.startup_only:
+        sys.exit(0)
+    if args.workers > 0:
+        sys.exit(serve(args.host, args.port, args.workers, args.max_requests, args.graceful_timeout))
+    app.run(host=args.host, port=args.port, debug=not args.debug)
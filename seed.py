@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Author:         Carl, Chris
+Email:          chrisbcarl@gmail.com
+Date:           2021-02-27
+Description:
+
+Raze and seed a sqlite database for general-flask-sqlalchemy-api.py to chew on,
+so performance changes get measured instead of guessed (see bench.py).
+
+Same --random-seed, same rows, every time. Tables:
+    narrow      a handful of typed columns with a few indexes, the common case
+    wide        --wide-columns columns of mixed types, the serializer's worst day
+    text_heavy  a title and a --text-bytes body, the bytes-on-the-wire worst day
+    composite   a two column primary key, for the cursor and upsert paths
+'''
+
+# stdlib imports
+from __future__ import print_function, absolute_import, division
+import os
+import sys
+import time
+import random
+import decimal
+import datetime
+import argparse
+
+# 3rd party imports
+from sqlalchemy import (
+    create_engine, event, MetaData, Table, Column, Index, Integer, String, Numeric, DateTime, Text, Boolean
+)
+
+# constants
+FILE_DIRPATH = os.path.abspath(os.path.dirname(__file__))
+CACHE_DIRPATH = os.path.join(FILE_DIRPATH, 'ignoreme')
+DB_FILEPATH = os.path.join(CACHE_DIRPATH, 'seed.db')
+TABLES = ['narrow', 'wide', 'text_heavy', 'composite']
+STATUSES = ['new', 'open', 'pending', 'closed', 'archived']
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore '
+    'magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo'
+).split()
+EPOCH = datetime.datetime(2021, 1, 1)
+
+
+def define_tables(metadata, wide_columns):
+    # type: (MetaData, int) -> dict
+    tables = {}
+    tables['narrow'] = Table(
+        'narrow',
+        metadata,
+        Column('id', Integer, primary_key=True, autoincrement=False),
+        Column('name', String(50)),
+        Column('age', Integer),
+        Column('status', String(10)),
+        Column('amount', Numeric(12, 2)),
+        Column('created', DateTime),
+        Index('ix_narrow_age', 'age'),
+        Index('ix_narrow_status', 'status'),
+        Index('ix_narrow_created', 'created'),
+    )
+    columns = []
+    for i in range(wide_columns):
+        kind = i % 4
+        if kind == 0:
+            columns.append(Column('s{:03d}'.format(i), String(100)))
+        elif kind == 1:
+            columns.append(Column('i{:03d}'.format(i), Integer))
+        elif kind == 2:
+            columns.append(Column('d{:03d}'.format(i), DateTime))
+        else:
+            columns.append(Column('b{:03d}'.format(i), Boolean))
+    tables['wide'] = Table('wide', metadata, Column('id', Integer, primary_key=True, autoincrement=False), *columns)
+    tables['text_heavy'] = Table(
+        'text_heavy',
+        metadata,
+        Column('id', Integer, primary_key=True, autoincrement=False),
+        Column('title', String(200)),
+        Column('body', Text),
+    )
+    tables['composite'] = Table(
+        'composite',
+        metadata,
+        Column('a', Integer, primary_key=True, autoincrement=False),
+        Column('b', Integer, primary_key=True, autoincrement=False),
+        Column('val', String(50)),
+    )
+    return tables
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def _text(rng, nbytes):
+    chunks, size = [], 0
+    while size < nbytes:
+        word = rng.choice(WORDS)
+        chunks.append(word)
+        size += len(word) + 1
+    return ' '.join(chunks)[:nbytes]
+
+
+def generate(table_name, table, rng, i, text_bytes):
+    # type: (str, Table, random.Random, int, int) -> dict
+    if table_name == 'narrow':
+        return dict(
+            id=i,
+            name='{} {}'.format(_words(rng, 2), i),
+            age=rng.randint(0, 99),
+            status=rng.choice(STATUSES),
+            amount=decimal.Decimal(rng.randint(0, 10 ** 8)) / 100,
+            created=EPOCH + datetime.timedelta(seconds=rng.randint(0, 5 * 365 * 24 * 3600)),
+        )
+    if table_name == 'wide':
+        row = dict(id=i)
+        for column in table.columns:
+            if column.name == 'id':
+                continue
+            kind = column.name[0]
+            if kind == 's':
+                row[column.name] = _words(rng, 4)
+            elif kind == 'i':
+                row[column.name] = rng.randint(-10 ** 6, 10 ** 6)
+            elif kind == 'd':
+                row[column.name] = EPOCH + datetime.timedelta(seconds=rng.randint(0, 10 ** 8))
+            else:
+                row[column.name] = rng.random() < 0.5
+        return row
+    if table_name == 'text_heavy':
+        return dict(id=i, title=_words(rng, 8), body=_text(rng, text_bytes))
+    return dict(a=i % 1000, b=i // 1000, val=_words(rng, 3))
+
+
+def seed(engine, tables, table_names, rows, text_bytes, random_seed, batch_size):
+    for table_name in table_names:
+        table = tables[table_name]
+        # each table gets its own generator, so picking --tables can't shift what the others get
+        rng = random.Random('{}:{}'.format(random_seed, table_name))
+        started = time.time()
+        with engine.begin() as connection:
+            batch = []
+            for i in range(1, rows + 1):
+                batch.append(generate(table_name, table, rng, i, text_bytes))
+                if len(batch) >= batch_size:
+                    connection.execute(table.insert(), batch)
+                    batch = []
+            if batch:
+                connection.execute(table.insert(), batch)
+        print('seeded {} rows into {!r} in {:.3f}s'.format(rows, table_name, time.time() - started))
+
+
+def raze(engine, metadata):
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'seed', formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__
+    )
+    parser.add_argument('--filepath', default=DB_FILEPATH, help='the sqlite file, default "%(default)s"')
+    parser.add_argument('--rows', type=int, default=100000, help='rows per table, default %(default)s')
+    parser.add_argument('--tables', default=','.join(TABLES), help='which of {}, default all of them'.format(TABLES))
+    parser.add_argument('--wide-columns', type=int, default=60, help='columns in "wide", default %(default)s')
+    parser.add_argument('--text-bytes', type=int, default=4000, help='size of "text_heavy" bodies, default %(default)s')
+    parser.add_argument('--random-seed', default='general-flask-sqlalchemy-api', help='default "%(default)s"')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows per executemany, default %(default)s')
+    parser.add_argument(
+        '--conf', default=None, help='also write an app config pointing at the database to this path'
+    )
+    args = parser.parse_args()
+
+    table_names = [t.strip() for t in args.tables.split(',') if t.strip()]
+    for table_name in table_names:
+        if table_name not in TABLES:
+            raise ValueError('{!r} not in {}'.format(table_name, TABLES))
+    dirpath = os.path.dirname(os.path.abspath(args.filepath))
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+
+    engine = create_engine('sqlite:///{}'.format(os.path.abspath(args.filepath)))
+
+    @event.listens_for(engine, 'connect')
+    def _pragmas(dbapi_connection, connection_record):
+        # a throwaway database, durability can take the day off
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=OFF')
+        cursor.close()
+
+    metadata = MetaData()
+    tables = define_tables(metadata, args.wide_columns)
+    raze(engine, metadata)
+    seed(engine, tables, table_names, args.rows, args.text_bytes, args.random_seed, args.batch_size)
+
+    if args.conf is not None:
+        with open(args.conf, 'w') as w:
+            w.write('[odbc]\nconnection_string=sqlite:///{}\n'.format(os.path.abspath(args.filepath)))
+        print('wrote "{}"'.format(args.conf))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
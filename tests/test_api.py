@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Behavior tests for general-flask-sqlalchemy-api.py against throwaway sqlite files.
+
+    python -m pip install -r requirements.txt pytest
+    python -m pytest -q tests
+'''
+
+# stdlib imports
+from __future__ import print_function, absolute_import, division
+import os
+import shutil
+import sqlite3
+import logging
+import multiprocessing
+import importlib.util
+
+# 3rd party imports
+import pytest
+
+# constants
+API_FILEPATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'general-flask-sqlalchemy-api.py'
+)
+ROWS = 20
+
+
+def make_db(filepath, rows=ROWS, name='name{:03d}'):
+    # type: (str, int, str) -> str
+    connection = sqlite3.connect(filepath)
+    connection.execute(
+        'CREATE TABLE people (id INTEGER PRIMARY KEY, name VARCHAR(50), age INTEGER, status VARCHAR(10))'
+    )
+    connection.execute('CREATE TABLE pairs (a INTEGER, b INTEGER, val TEXT, PRIMARY KEY (a, b))')
+    for i in range(1, rows + 1):
+        connection.execute('INSERT INTO people VALUES (?, ?, ?, ?)', (i, name.format(i), i % 7 * 10, 'abc'[i % 3]))
+        connection.execute('INSERT INTO pairs VALUES (?, ?, ?)', (i % 5, i, 'v{}'.format(i)))
+    connection.commit()
+    connection.close()
+    return 'sqlite:///{}'.format(filepath)
+
+
+@pytest.fixture
+def load_api():
+    # the module keeps its engine, registry and caches in globals, so every test gets a copy of its own
+    loaded = []
+
+    def load(connection_string, **kwargs):
+        spec = importlib.util.spec_from_file_location('api_{}'.format(len(loaded)), API_FILEPATH)
+        api = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(api)
+        loaded.append(api)
+        api.RESPONSE_CACHE.ttl = 0  # every GET has to actually go to the database
+        api.stack_it_up(connection_string, schema=None, **kwargs)
+        return api
+
+    yield load
+    for api in loaded:
+        for handler in [api._stream_hndl, api._file_hndl]:
+            api.app.logger.removeHandler(handler)
+            logging.getLogger('werkzeug').removeHandler(handler)
+            handler.close()
+        api.dispose_engines()
+
+
+@pytest.fixture
+def api(load_api, tmpdir):
+    return load_api(make_db(str(tmpdir.join('primary.db'))))
+
+
+def test_put_item_changing_the_primary_key(api):
+    client = api.app.test_client()
+    response = client.put('/api/v1/people/11', json={'id': 90011, 'name': 'moved'})
+    assert response.status_code == 200
+    assert response.get_json() == [{'id': 90011, 'name': 'moved', 'age': 40, 'status': 'c'}]
+    assert client.get('/api/v1/people/11').get_json() == []
+    assert client.get('/api/v1/people/90011').get_json()[0]['name'] == 'moved'
+
+
+def test_put_item_missing(api):
+    client = api.app.test_client()
+    assert client.put('/api/v1/people/999', json={'name': 'nobody'}).get_json() == []
+
+
+def test_search_index_follows_an_id_changing_put(api):
+    api.SEARCH_INDEXES = api.parse_search_indexes('people.name')
+    client = api.app.test_client()
+    assert [r['id'] for r in client.get('/api/v1/people?search_key=name&search=name011').get_json()] == [11]
+    client.put('/api/v1/people/11', json={'id': 90011})
+    client.put('/api/v1/people/12', json={'id': 90012, 'name': 'renamed'})
+    index = api.SEARCH_INDEXES['people']['name']
+    assert not index.stale and index.builds == 1
+    assert [r['id'] for r in client.get('/api/v1/people?search_key=name&search=name011').get_json()] == [90011]
+    assert client.get('/api/v1/people?search_key=name&search=name012').get_json() == []
+    assert [r['id'] for r in client.get('/api/v1/people?search_key=name&search=renamed').get_json()] == [90012]
+    assert 11 not in index.texts and 12 not in index.texts
+
+
+@pytest.fixture
+def replicated(load_api, tmpdir):
+    # two sqlite files, the replica's rows named differently so it's plain which one answered
+    primary = make_db(str(tmpdir.join('primary.db')))
+    replica = make_db(str(tmpdir.mkdir('replica').join('replica.db')), name='replica{:03d}')
+    pool = dict(pool_size=2, max_overflow=0, pool_recycle=60, pool_pre_ping=False, pool_timeout=5)
+    return load_api(primary, replicas=[('replica', replica, pool)])
+
+
+def test_reads_go_to_the_replica(replicated):
+    client = replicated.app.test_client()
+    assert client.get('/api/v1/people/1').get_json()[0]['name'] == 'replica001'
+    assert client.get('/api/v1/people/_aggregate?count=*').get_json() == [{'count': ROWS}]
+
+
+def test_replica_failing_falls_back_to_the_primary(replicated):
+    replica = replicated.REPLICAS[0]
+    replica.engine.dispose()
+    shutil.rmtree(os.path.dirname(replica.engine.url.database))  # a replica gone away, it can't even connect
+    client = replicated.app.test_client()
+    response = client.get('/api/v1/people/1')
+    assert response.get_json()[0]['name'] == 'name001'  # the primary, instead of an error
+    assert replica.failures == 1
+    assert not replica.snapshot()['healthy']
+    assert client.get('/api/v1/people/2').get_json()[0]['name'] == 'name002'
+    assert replica.failures == 1  # sitting out, not tried again
+    assert client.get('/api/v1/people/_aggregate?count=*').get_json() == [{'count': ROWS}]
+
+
+def test_ordinary_errors_are_not_retried_on_the_primary(replicated):
+    client = replicated.app.test_client()
+    assert 'error' in client.get('/api/v1/people?filter=nope:eq:1').get_json()
+    assert replicated.REPLICAS[0].failures == 0
+
+
+def test_read_your_writes(replicated):
+    writer = replicated.app.test_client()
+    response = writer.post('/api/v1/people', json={'id': 500, 'name': 'new'})
+    assert replicated.READ_YOUR_WRITES_COOKIE in response.headers.get('Set-Cookie', '')
+    assert writer.get('/api/v1/people/500').get_json()[0]['name'] == 'new'  # the primary, it has the write
+    assert writer.get('/api/v1/people/1').get_json()[0]['name'] == 'name001'
+    reader = replicated.app.test_client()
+    assert reader.get('/api/v1/people/500').get_json() == []  # the replica, it doesn't
+    assert reader.get('/api/v1/people/1').get_json()[0]['name'] == 'replica001'
+
+
+def test_put_filtered(api):
+    client = api.app.test_client()
+    matched = client.get('/api/v1/people?filter=status:eq:a').get_json()
+    assert client.put('/api/v1/people?filter=status:eq:a&dry_run=1', json={'age': 99}).get_json() == {
+        'matched': len(matched), 'dry_run': True
+    }
+    assert client.put('/api/v1/people?filter=status:eq:a', json={'age': 99}).get_json() == {'updated': len(matched)}
+    assert set(r['age'] for r in client.get('/api/v1/people?filter=status:eq:a').get_json()) == {99}
+    assert 99 not in set(r['age'] for r in client.get('/api/v1/people?filter=status:ne:a').get_json())
+
+
+def test_put_without_filters_needs_all(api):
+    client = api.app.test_client()
+    assert 'error' in client.put('/api/v1/people', json={'age': 1}).get_json()
+    assert client.put('/api/v1/people?all=1', json={'age': 1}).get_json() == {'updated': ROWS}
+
+
+def test_batch_transaction_rolls_back(api):
+    client = api.app.test_client()
+    operations = [
+        {'method': 'POST', 'resource': 'people', 'body': {'id': 500, 'name': 'new'}},
+        {'method': 'PUT', 'resource': 'people', 'id': 1, 'body': {'name': 'changed'}},
+        {'method': 'POST', 'resource': 'people', 'body': {'nope': 1}},
+        {'method': 'DELETE', 'resource': 'people', 'id': 2},
+    ]
+    results = client.post('/api/v1/_batch?transaction=1', json=operations).get_json()
+    assert [r['status'] for r in results] == [200, 200, 200, 424]
+    assert [r['rolled_back'] for r in results] == [True, True, False, False]
+    assert 'error' in results[2]['body']
+    assert client.get('/api/v1/people/500').get_json() == []
+    assert client.get('/api/v1/people/1').get_json()[0]['name'] == 'name001'
+    assert client.get('/api/v1/people/2').get_json()
+
+
+def test_batch_without_a_transaction_keeps_going(api):
+    client = api.app.test_client()
+    operations = [
+        {'method': 'POST', 'resource': 'people', 'body': {'nope': 1}},
+        {'method': 'DELETE', 'resource': 'people', 'id': 2},
+    ]
+    results = client.post('/api/v1/_batch', json=operations).get_json()
+    assert 'error' in results[0]['body'] and results[1]['body'] == ['2']
+    assert client.get('/api/v1/people/2').get_json() == []
+
+
+def _changes_token(client):
+    # the token at the end of everything there is now
+    answer = client.get('/api/v1/people/_changes').get_json()
+    while answer['more']:
+        answer = client.get('/api/v1/people/_changes?since={}'.format(answer['next'])).get_json()
+    return answer['next']
+
+
+def test_change_feed_deletes_complete(api):
+    api.CHANGE_FEEDS = api.parse_change_feeds('people.id')
+    client = api.app.test_client()
+    token = _changes_token(client)
+    client.delete('/api/v1/people/2')
+    client.delete('/api/v1/people/5')
+    client.post('/api/v1/people', json={'id': 500, 'name': 'new'})
+    answer = client.get('/api/v1/people/_changes?since={}'.format(token)).get_json()
+    assert answer['deleted'] == [2, 5]
+    assert [r['id'] for r in answer['changes']] == [500]
+    assert answer['complete'] is True
+    answer = client.get('/api/v1/people/_changes?since={}'.format(answer['next'])).get_json()
+    assert answer['deleted'] == [] and answer['changes'] == [] and answer['complete'] is True
+
+
+def test_change_feed_after_a_restart_is_incomplete(api):
+    api.CHANGE_FEEDS = api.parse_change_feeds('people.id')
+    client = api.app.test_client()
+    token = _changes_token(client)
+    client.delete('/api/v1/people/2')
+    api.CHANGE_FEEDS = api.parse_change_feeds('people.id')  # what a restart leaves behind
+    answer = client.get('/api/v1/people/_changes?since={}'.format(token)).get_json()
+    assert answer['complete'] is False
+
+
+def test_change_feed_deletes_through_another_worker_are_incomplete(api):
+    api.CHANGE_FEEDS = api.parse_change_feeds('people.id')
+    feed = api.CHANGE_FEEDS['people']
+    feed.shared = multiprocessing.Value('L', 0)  # what serve gives every worker
+    client = api.app.test_client()
+    token = _changes_token(client)
+    client.delete('/api/v1/people/2')
+    with feed.shared.get_lock():
+        feed.shared.value += 1  # a delete some other worker did
+    client.delete('/api/v1/people/5')
+    answer = client.get('/api/v1/people/_changes?since={}'.format(token)).get_json()
+    assert answer['deleted'] == [2, 5]
+    assert answer['complete'] is False
+    answer = client.get('/api/v1/people/_changes?since={}'.format(answer['next'])).get_json()
+    assert answer['complete'] is True